@@ -106,6 +106,50 @@ options:
       - Any other credentials previously supplied, must be provided again.
       required: false
       type: dict
+    max_retries:
+      description:
+      - Number of times a request is retried when the instance throttles it with HTTP status 429, whatever its method.
+      - Requests that do not change records, or can be sent again without changing them more, like deletes, are also
+        retried on HTTP status 500, 502, 503 and 504, connection errors and timeouts.
+      - Set to 0 to not retry.
+      - If the value is not specified in the task, the value of environment variable C(SN_MAX_RETRIES) will be used instead.
+      type: int
+      default: 3
+    retry_backoff:
+      description:
+      - Seconds the first retry waits at most, doubled for each following retry. Each wait is a random time up to that.
+      - A C(Retry-After) header sent by the instance is used instead.
+      - If the value is not specified in the task, the value of environment variable C(SN_RETRY_BACKOFF) will be used instead.
+      type: float
+      default: 1.0
+    retry_max_delay:
+      description:
+      - Longest wait before a retry, in seconds, including one asked for with C(Retry-After).
+      - If the value is not specified in the task, the value of environment variable C(SN_RETRY_MAX_DELAY) will be used instead.
+      type: float
+      default: 60.0
+    lean_transport:
+      description:
+      - Ask for gzip compressed responses only, do not have the instance count the matching records, with
+        C(sysparm_no_count), and exclude reference links by default.
+      - The bytes received and the bytes of the decoded responses are returned in C(transfer).
+      - If the value is not specified in the task, the value of environment variable C(SN_LEAN_TRANSPORT) will be used instead.
+      type: bool
+      default: false
+    rate_limit:
+      description:
+      - Most requests per second sent to the instance by all the tasks, and inventories, of the user on the controller
+        that set it, as they share one token bucket per instance, kept in a file of the temporary directory.
+      - Retries take a token too.
+      - Set to 0 to not limit requests.
+      - If the value is not specified in the task, the value of environment variable C(SN_RATE_LIMIT) will be used instead.
+      type: float
+      default: 0
+    rate_limit_burst:
+      description:
+      - Number of requests that can be sent at once after a quiet period, defaults to one second of I(rate_limit).
+      - If the value is not specified in the task, the value of environment variable C(SN_RATE_LIMIT_BURST) will be used instead.
+      type: int
 deprecated:
   removed_in: "6.0.0"
   why: This collection is deprecated in favor of servicenow.itsm
@@ -57,10 +57,31 @@ DOCUMENTATION = r'''
           description:
           - Password for username.
           - If the value is not specified, the value of environment variable C(SN_PASSWORD) will be used instead.
-          required: true
+          - Required unless every entry of I(instances) sets its own C(password).
+          required: false
           type: str
           env:
             - name: SN_PASSWORD
+        instances:
+            description:
+             - List of ServiceNow instances to build one inventory from, fetched in parallel.
+             - Each entry is a dictionary with an C(instance) or C(host) key and optional C(username), C(password) and
+               C(proxy) keys, which default to the top level options of the same name.
+             - Every host gets a C(sn_instance) variable holding the instance or host it was found on, and each instance
+               is cached under its own cache key.
+             - Overrides I(instance) and I(host).
+            type: list
+            elements: dict
+        instance_conflict:
+            description:
+             - What to do when the same host is returned by more than one entry of I(instances).
+             - C(first) keeps the host from the first instance in the list that returns it, C(last) from the last one.
+             - C(error) fails the inventory source.
+             - The instances are fetched at once and their hosts added as the pages come in, except with C(last),
+               which holds the records of every instance until all are fetched.
+            type: str
+            choices: ['first', 'last', 'error']
+            default: first
         table:
             description: The ServiceNow table to query.
             type: string
@@ -70,12 +91,61 @@ DOCUMENTATION = r'''
             - Comma seperated string providing additional table columns to add as host vars to each inventory host.
             - Related table fields are valid.  Usual period separator is changed to underscore.
             - e.g. sn_model_id.model_name -> sn_model_id_model_name
+            - Fields only used by playbooks can be left to the C(servicenow.servicenow.now) vars plugin, which fetches
+              them for the hosts a play targets. It needs C(sys_id) in this list.
             type: list
             default: 'ip_address,fqdn,host_name,sys_class_name,name'
         selection_order:
             description: Comma seperated string providing ability to define selection preference order.
             type: list
             default: 'ip_address,fqdn,host_name,name'
+        push_down_groups:
+            description:
+             - Only fetch the records that can be in one of the I(groups), by adding their conditions to
+               I(filter_results) as encoded query clauses. Hosts that are in none of the I(groups) are then left out
+               of the inventory.
+             - Every condition must be made of C(sn_*) variables of requested fields, without filters, compared with
+               C(==) or C(!=) to a string, or with C(in) or C(not in) to a list of strings, joined with C(and), for
+               example C(sn_os == 'Linux Red Hat' and sn_fqdn != ''). Otherwise a warning is shown and nothing is
+               added.
+             - The instance compares strings ignoring case, so it may return records that are then in none of the
+               groups, never fewer. For the same reason, C(!=) a non empty string and C(not in) are left out of the
+               query, and a condition made of them only is not added.
+             - The instance compares the stored values of fields while host variables hold their display values, so
+               only plain text fields of the table can be used. Choice, reference and class fields, such as
+               C(install_status), C(location) or C(sys_class_name), fields of other types and fields of related
+               tables cannot. The types are looked up on the instance, the first one with I(instances).
+             - The conditions are still evaluated for each host, so a record matched on the instance only becomes a
+               member of the groups it matches locally.
+            type: bool
+            default: False
+        prune_fields:
+            description:
+             - Only request the fields of I(fields) that are used, as C(sn_*) variables, by I(compose), I(groups) or
+               I(keyed_groups), or that are in I(selection_order) or I(pinned_fields). The other fields are not
+               fetched, so they are not available as host variables.
+             - C(sys_id) is always kept when it is in I(fields), as the C(servicenow.servicenow.now) vars plugin finds
+               the record of a host from it.
+            type: bool
+            default: False
+        pinned_fields:
+            description:
+             - Fields always requested when I(prune_fields) is enabled, for instance those used by playbooks.
+            type: list
+            elements: str
+            default: []
+        tables:
+            description:
+             - List of tables to build the inventory from, fetched concurrently over one shared connection pool.
+             - Each entry is a dictionary with a required C(table) key and optional C(fields), C(filter_results) and
+               C(selection_order) keys, which default to the top level options of the same name.
+             - When the same host is returned by more than one table, the first table in the list that returns it
+               provides its host variables and groups, and the records from later tables are ignored.
+             - The hosts of each table are added as its pages come in, a table fetched ahead of its turn waits once it
+               holds a page, rather than holding all its records.
+             - Overrides I(table).
+            type: list
+            elements: dict
         filter_results:
             description: Filter results with sysparm_query encoded query string syntax. Complete list of operators available for filters and queries.
             type: string
@@ -86,16 +156,232 @@ DOCUMENTATION = r'''
             description: Proxy server to use for requests to ServiceNow.
             type: string
             default: ''
+        timeout:
+            description:
+             - Seconds to wait for the instance to accept a connection, then for each part of a response. A request
+               timing out is retried, see I(max_retries).
+            type: float
+            default: 60.0
+            env:
+              - name: SN_TIMEOUT
+        max_retries:
+            description:
+             - Number of times a request is retried when the instance throttles it with HTTP status 429 or fails with
+               HTTP status 500, 502, 503 or 504, a connection error or a timeout. Set to C(0) to not retry.
+            type: int
+            default: 3
+            env:
+              - name: SN_MAX_RETRIES
+        retry_backoff:
+            description:
+             - Seconds the first retry waits at most, doubled for each following retry. Each wait is a random time up
+               to that.
+             - A C(Retry-After) header sent by the instance is used instead.
+            type: float
+            default: 1.0
+            env:
+              - name: SN_RETRY_BACKOFF
+        retry_max_delay:
+            description: Longest wait before a retry, in seconds, including one asked for with C(Retry-After).
+            type: float
+            default: 60.0
+            env:
+              - name: SN_RETRY_MAX_DELAY
+        lean_transport:
+            description:
+             - Ask for gzip compressed responses only, and for the record count of the instance, which costs it a
+               C(select count(*)), on the first page of each result set only, with C(sysparm_no_count) on the others.
+             - Pages after the first are then fetched by C(sysparm_offset) windows of the size of the first page,
+               until one comes back short, instead of following C(Link) headers, which need the count. With
+               I(pagination=keyset), no page asks for the count.
+             - Reference links are excluded from the results in any case.
+            type: bool
+            default: False
+        rate_limit:
+            description:
+             - Most requests per second sent to each instance, shared with the tasks and other inventories of the user
+               on the controller that set it, through one token bucket per instance kept in a file of the temporary
+               directory. Set to C(0) to not limit requests.
+            type: float
+            default: 0
+            env:
+              - name: SN_RATE_LIMIT
+        rate_limit_burst:
+            description:
+             - Number of requests that can be sent at once after a quiet period, defaults to one second of
+               I(rate_limit).
+            type: int
+            env:
+              - name: SN_RATE_LIMIT_BURST
         enhanced:
             description:
              - Enable enhanced inventory which provides relationship information from CMDB.
-             - Requires installation of Update Set located in update_sets directory.
+             - Requires installation of Update Set located in update_sets directory, unless I(enhanced_source=table_api).
             type: bool
             default: False
         enhanced_groups:
             description: enable enhanced groups from CMDB relationships. Only used if enhanced is enabled.
             type: bool
             default: True
+        enhanced_source:
+            description:
+             - Where the relationship information of the enhanced inventory comes from. Only used if enhanced is enabled.
+             - C(scripted_rest) uses the scripted REST API installed by the Update Set, which looks up the relationships of every CI
+               on the instance.
+             - C(table_api) fetches the matching C(cmdb_rel_ci) records in bulk through the Table API, C(sys_idIN) batches at a time,
+               and builds the same relationship groups on the controller. No Update Set is needed.
+            type: str
+            choices: ['scripted_rest', 'table_api']
+            default: scripted_rest
+        page_workers:
+            description:
+             - Number of result pages to fetch concurrently.
+             - When greater than 1, the record count is read from the C(X-Total-Count) header of the first page and the
+               remaining C(sysparm_offset)/C(sysparm_limit) windows are fetched on a pool of this many workers.
+             - Pages are merged back in order, so the inventory is the same as with a serial fetch.
+             - When the first response carries no record count, pages are fetched one at a time by following C(Link) headers.
+            type: int
+            default: 1
+        page_size:
+            description:
+             - Number of records to request per page with C(sysparm_limit).
+             - If not set, the default page size of the instance, or of the enhanced inventory scripted REST API, is used.
+            type: int
+        pagination:
+            description:
+             - How result pages are walked.
+             - C(offset) follows the C(Link) headers returned by the instance, or fetches C(sysparm_offset) windows
+               concurrently when I(page_workers) is greater than 1.
+             - C(keyset) orders records by C(sys_id) and requests every page with C(sys_id>last_seen), so deep pages cost
+               the same as the first one and records are neither duplicated nor skipped while the table changes.
+             - C(keyset) ignores I(page_workers), drops any C(ORDERBY) from I(filter_results) and is not supported with
+               I(enhanced_source=scripted_rest).
+            type: str
+            choices: ['offset', 'keyset']
+            default: offset
+        incremental:
+            description:
+             - Keep a snapshot of the table in the inventory cache, keyed by C(sys_id), and only fetch records whose
+               C(sys_updated_on) is later than the previous sync on each run.
+             - Records deleted from the table, or no longer matching I(filter_results), are removed after a listing of
+               matching C(sys_id) values only.
+             - Requires I(cache) to be enabled. Set I(cache_timeout) to cover the interval between runs, otherwise the
+               snapshot expires and a full sync is done. Use C(--flush-cache) to force a full sync.
+             - Not supported with I(enhanced), as relationship changes do not update the CI.
+            type: bool
+            default: False
+        hoist_group_vars:
+            description:
+             - Move the C(sn_*) variables that have the same value on every host of a group created by this plugin,
+               with at least two hosts, to the variables of the group, so the inventory and the output of
+               C(ansible-inventory --list) are smaller.
+             - A moved variable gets the precedence of inventory group variables instead of inventory host
+               variables, below C(group_vars) files, so one also set in C(group_vars), or by another inventory source,
+               may resolve to another value. I(compose) variables, such as C(ansible_host), are never moved.
+            type: bool
+            default: False
+        cache_entry_timeout:
+            description:
+             - Seconds a cached result set stays valid, counted from when it was fetched. C(0) keeps it for as long as
+               the inventory cache itself, see I(cache_timeout).
+             - The cache holds one result set per request fingerprint, made of the table, fields, query and enhanced
+               settings, so changing one of these only fetches the result sets that changed.
+            type: int
+            default: 0
+        cache_revalidate:
+            description:
+             - Before using a cached result set, ask the instance for the number of matching records and the newest
+               C(sys_updated_on) among them, with a single record request, and only fetch the records again when
+               either differs from what was stored with the cache.
+             - Unchanged result sets are reused even after I(cache_entry_timeout), so it can be set long, or to C(0),
+               with I(cache_timeout) also set to C(0) for the inventory cache not to expire on its own.
+             - Relationship changes of the enhanced inventory and deletions balanced by as many new records with older
+               update times are not detected.
+             - Not used with I(incremental), which already syncs the cache with the instance.
+            type: bool
+            default: False
+        cache_stale_window:
+            description:
+             - Seconds past I(cache_entry_timeout) during which an expired result set is still used, so the inventory
+               loads from the cache right away, while a detached C(ansible-inventory) process fetches the records again
+               and replaces the cache. The inventory is then at most one refresh old.
+             - Only used with a persistent cache plugin and I(cache_entry_timeout) set. C(0) waits for the records
+               instead.
+             - The background process is run with the C(SN_INVENTORY_REFRESH) environment variable set, which makes
+               the plugin ignore expired result sets and not start another refresh. At most one is started per
+               I(cache_entry_timeout), as recorded on a marker file next to the lock of I(cache_lock).
+             - Result sets stored by the background process are kept over the older ones of the processes that
+               served them stale, as every process merges the cache on disk into its own before writing it.
+            type: int
+            default: 0
+        cache_format:
+            description:
+             - How result sets are stored in the inventory cache.
+             - C(records) stores the list of records as returned by the instance.
+             - C(columnar) stores every field once as a column, with the values of fields repeated across records, like
+               C(sys_class_name), replaced by their index in a list of distinct values, and compresses the result with
+               zlib. The cache is many times smaller and loads faster.
+             - The snapshot of I(incremental) is always stored as records.
+            type: str
+            choices: ['records', 'columnar']
+            default: records
+        cache_lock:
+            description:
+             - Let a single process fetch the records of a cache key at a time, when several C(ansible-playbook) or
+               C(ansible-inventory) processes miss the inventory cache at once. The others wait for it, then use the
+               records it stored in the cache.
+             - Uses an advisory C(flock) lock on a file in I(cache_connection), or in a directory of the user in the
+               temporary directory, which is released when the process holding it exits, even when killed. Not used
+               with the C(memory) cache plugin.
+            type: bool
+            default: False
+        cache_lock_timeout:
+            description:
+             - Seconds to wait for another process to fill the cache, see I(cache_lock), before fetching the records
+               anyway.
+            type: int
+            default: 300
+        cache_max_entries:
+            description:
+             - Number of result sets kept in the inventory cache of each instance. The least recently used ones are
+               evicted first.
+            type: int
+            default: 16
+        export_artifact:
+            description:
+             - Path of a file to write the built inventory to, with its hosts, host variables, composed variables and
+               groups, as gzip compressed JSON in the layout of C(ansible-inventory --list).
+             - Only the hosts and groups added by this source are written, not those of the inventory sources parsed
+               before it.
+             - The file is replaced at once, so an inventory loading it never reads it half written.
+            type: path
+        load_artifact:
+            description:
+             - Path of a file written with I(export_artifact) to load the inventory from, instead of building it.
+               Nothing is fetched, templated or grouped again, and no credentials are needed.
+             - Overrides every other way of building the inventory, the file must exist.
+            type: path
+        daemon_socket:
+            description:
+             - Path of the Unix socket of an inventory daemon to read the built inventory from, instead of building it.
+             - The daemon is started with C(scripts/inventory_daemon.py) of this collection, usually with this same
+               configuration file. It keeps the inventory built and refreshes it on a schedule, which is incremental
+               with I(incremental) and a persistent I(cache_plugin).
+             - When the daemon cannot be reached, a warning is shown and the inventory is built as usual.
+            type: str
+            env:
+              - name: SN_INVENTORY_DAEMON_SOCKET
+        daemon_url:
+            description:
+             - HTTP URL of an inventory daemon started with C(--listen), used like I(daemon_socket).
+             - Ignored when I(daemon_socket) is set.
+            type: str
+            env:
+              - name: SN_INVENTORY_DAEMON_URL
+        daemon_timeout:
+            description: Seconds to wait for the inventory daemon before building the inventory instead.
+            type: int
+            default: 10
 
 '''
 
@@ -143,6 +429,37 @@ keyed_groups:
   - key: sn_tags | lower
     prefix: 'tag'
 
+# Servers and network gear in one inventory
+plugin: servicenow.servicenow.now
+instance: dev89007
+username: admin
+password: password
+tables:
+  - table: cmdb_ci_linux_server
+    fields: [name,fqdn,ip_address,sys_class_name,os_version]
+  - table: cmdb_ci_netgear
+    fields: [name,ip_address,sys_class_name,model_id.model_number]
+    filter_results: operational_status=1
+    selection_order: ip_address
+keyed_groups:
+  - key: sn_sys_class_name | lower
+    prefix: ''
+    separator: ''
+
+# Merge the CMDB of two instances
+plugin: servicenow.servicenow.now
+username: admin
+password: password
+instances:
+  - instance: emea01
+  - host: servicenow.americas.example.com
+    username: inventory
+    password: secret
+instance_conflict: last
+keyed_groups:
+  - key: sn_instance
+    prefix: instance
+
 # Use related table field
 plugin: servicenow.servicenow.now
 instance: dev89007
@@ -155,8 +472,38 @@ filter_results: operational_status=1^fqdnISNOTEMPTY^manufacturerSTARTSWITHCisco
 keyed_groups:
   - key: sn_model_id_model_number | lower
     prefix: 'model'
+
+# Read the inventory from a daemon that keeps it built, started with
+# python scripts/inventory_daemon.py --socket /run/servicenow/inventory.sock now.yml
+plugin: servicenow.servicenow.now
+instance: dev89007
+username: admin
+password: password
+incremental: true
+cache: true
+cache_plugin: ansible.builtin.jsonfile
+cache_connection: /var/cache/servicenow
+daemon_socket: /run/servicenow/inventory.sock
 '''
 
+import base64
+import errno
+import fcntl
+import gzip
+import json
+import math
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from itertools import islice
+
 try:
     import netaddr
     HAS_NETADDR = True
@@ -169,8 +516,363 @@ try:
 except ImportError:
     HAS_REQUESTS = False
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+    HAS_FUTURES = True
+except ImportError:
+    HAS_FUTURES = False
+
 from ansible.errors import AnsibleError, AnsibleParserError
-from ansible.plugins.inventory import BaseInventoryPlugin, Constructable, Cacheable, to_safe_group_name
+from ansible.module_utils.common._collections_compat import Mapping
+from ansible.module_utils.six import PY3, string_types
+from ansible.module_utils.six.moves import http_client, queue
+from ansible.module_utils.six.moves.urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from ansible.parsing.ajson import AnsibleJSONEncoder
+from ansible.plugins.inventory import BaseInventoryPlugin, Constructable, Cacheable, get_cache_plugin, to_safe_group_name
+from ansible.utils.vars import combine_vars
+from ansible_collections.servicenow.servicenow.plugins.module_utils.service_now import (
+    RateLimiter, RetryAdapter, and_query, keyset_query, order_query, private_dir)
+
+# number of sys_ids per sys_idIN query
+SYS_ID_CHUNK = 100
+
+# number of fetched pages waiting for the host building loop
+PIPELINE_DEPTH = 1
+
+# types of the fields whose display value is their stored value, the only
+# ones groups conditions are pushed down on, and the number of parent
+# tables looked up for where they are defined
+PLAIN_TYPES = frozenset(['string', 'ip_address', 'email', 'url', 'GUID'])
+TABLE_DEPTH = 8
+
+# a field missing from a record while decoding a columnar result set, where
+# its index is null
+MISSING = object()
+
+# expressions of compose, groups and keyed_groups simple enough to be
+# evaluated without templating: a variable, with attribute or item lookups,
+# piped through lower, upper or trim, and groups comparing one with strings
+STRING = r'(?:\'[^\'\\]*\'|"[^"\\]*")'
+OPERAND = r'[A-Za-z_]\w*(?:\.[A-Za-z_]\w*|\[\s*%s\s*\])*(?:\s*\|\s*(?:lower|upper|trim)(?:\s*\(\s*\))?)*' % STRING
+OPERAND_RE = re.compile(r'\s*(%s)\s*$' % OPERAND)
+CLAUSE_RE = re.compile(r'\s*(%s)\s*(==|!=|not\s+in\b|in\b)\s*(%s|\[(?:\s*%s\s*,)*(?:\s*%s)?\s*\])\s*(and\b)?' %
+                       (OPERAND, STRING, STRING, STRING))
+TOKEN_RE = re.compile(r'([A-Za-z_]\w*)|\.([A-Za-z_]\w*)|\[\s*(%s)\s*\]|\|\s*(lower|upper|trim)(?:\s*\(\s*\))?|\s+' % STRING)
+FILTERS = {
+    'lower': lambda value: value.lower(),
+    'upper': lambda value: value.upper(),
+    'trim': lambda value: value.strip(),
+}
+# names that are jinja2 literals or operators rather than variables
+JINJA_NAMES = frozenset(['and', 'or', 'not', 'in', 'is', 'if', 'else', 'true', 'false', 'none', 'True', 'False', 'None'])
+
+
+class NotSimple(Exception):
+    ''' The expression has to be templated for this host. '''
+
+
+def parse_operand(expression):
+    ''' Split a simple operand into its variable, lookups and filters.
+
+    Returns None when the expression is not a simple operand.
+    '''
+    if not isinstance(expression, string_types) or not OPERAND_RE.match(expression):
+        return None
+    name = None
+    lookups = []
+    filters = []
+    for token in TOKEN_RE.finditer(expression.strip()):
+        ident, attribute, item, name_filter = token.groups()
+        if ident:
+            name = ident
+        elif attribute:
+            # attributes of dicts shadow their keys in jinja2
+            if hasattr(dict, attribute) or filters:
+                return None
+            lookups.append(attribute)
+        elif item:
+            if filters:
+                return None
+            lookups.append(item[1:-1])
+        elif name_filter:
+            filters.append(FILTERS[name_filter])
+    if name in JINJA_NAMES:
+        return None
+    return name, lookups, filters
+
+
+def parse_condition(expression):
+    ''' Split a groups condition into clauses of an operand, an operator and
+    the string or list of strings it is compared with, all of which must hold.
+
+    Returns None when the condition is not made of such clauses only.
+    '''
+    if not isinstance(expression, string_types):
+        return None
+    clauses = []
+    pos = 0
+    expecting = True
+    while expecting:
+        match = CLAUSE_RE.match(expression, pos)
+        if not match:
+            return None
+        operand = parse_operand(match.group(1))
+        if operand is None:
+            return None
+        operator = ' '.join(match.group(2).split())
+        literal = match.group(3)
+        if literal.startswith('['):
+            literal = [string[1:-1] for string in re.findall(STRING, literal)]
+        else:
+            literal = literal[1:-1]
+        clauses.append((operand, operator, literal))
+        pos = match.end()
+        expecting = bool(match.group(4))
+    if expression[pos:].strip():
+        return None
+    return clauses
+
+
+def evaluate_operand(operand, variables):
+    ''' Evaluate a parsed operand against the variables of a host.
+
+    Raises NotSimple when templating could give a different result.
+    '''
+    name, lookups, filters = operand
+    if name not in variables:
+        raise NotSimple()
+    value = variables[name]
+    for key in lookups:
+        if not isinstance(value, Mapping) or key not in value:
+            raise NotSimple()
+        value = value[key]
+    if not isinstance(value, string_types) or '{{' in value or '{%' in value or '{#' in value:
+        raise NotSimple()
+    for name_filter in filters:
+        value = name_filter(value)
+    # older templating turns these into lists, dicts and booleans
+    if value.startswith(('[', '{')) or value in ('True', 'False'):
+        raise NotSimple()
+    return value
+
+
+def evaluate_condition(clauses, variables):
+    ''' Evaluate parsed groups condition clauses against the variables of a host. '''
+    for operand, operator, literal in clauses:
+        value = evaluate_operand(operand, variables)
+        if operator == '==':
+            result = value == literal
+        elif operator == '!=':
+            result = value != literal
+        elif operator == 'in':
+            result = value in literal
+        else:
+            result = value not in literal
+        if not result:
+            return False
+    return True
+
+
+def encode_condition(clauses, fields):
+    ''' Translate parsed groups condition clauses to an encoded query.
+
+    The query matches at least the records the condition holds for, and
+    may match more: string comparisons of the instance ignore case, so the
+    negated clauses, C(!=) a non empty string and C(not in), are left out.
+
+    :param clauses: clauses returned by parse_condition
+    :param fields: requested field names by their sn_ variable name
+    Returns None when a clause has no encoded query equivalent, or when
+    none is left.
+    '''
+    terms = []
+    for (name, lookups, filters), operator, literal in clauses:
+        if lookups or filters or name not in fields:
+            return None
+        field = fields[name]
+        values = [literal] if operator in ('==', '!=') else literal
+        # a string on the right of in is a substring test
+        if not isinstance(values, list) or not values or any(re.search(r'[\^&#%\n]', v) for v in values):
+            return None
+        if operator == '==':
+            terms.append('%sISEMPTY' % field if literal == '' else '%s=%s' % (field, literal))
+        elif operator == '!=':
+            if literal == '':
+                terms.append('%sISNOTEMPTY' % field)
+        elif any(',' in v or v == '' for v in values):
+            return None
+        elif operator == 'in':
+            terms.append('%sIN%s' % (field, ','.join(values)))
+    return '^'.join(terms) or None
+
+
+def encode_records(records):
+    ''' Encode a list of records as compressed columns.
+
+    Columns with few distinct values are dictionary encoded, each record
+    holding the index of its value, the others are stored as they are.
+    '''
+    fields = []
+    names = set()
+    for record in records:
+        for field in record:
+            if field not in names:
+                names.add(field)
+                fields.append(field)
+
+    columns = {}
+    for field in fields:
+        # lists and dicts are told apart by their json encoding
+        strings = {}
+        others = {}
+        distinct = []
+        index = []
+        for record in records:
+            if field not in record:
+                index.append(None)
+                continue
+            value = record[field]
+            if isinstance(value, string_types):
+                seen, key = strings, value
+            else:
+                seen, key = others, json.dumps(value, sort_keys=True)
+            i = seen.get(key)
+            if i is None:
+                i = seen[key] = len(distinct)
+                distinct.append(value)
+            index.append(i)
+
+        if None not in index and len(distinct) * 2 > len(records):
+            columns[field] = {'values': [record[field] for record in records]}
+        else:
+            columns[field] = {'distinct': distinct, 'index': index}
+
+    payload = json.dumps({'count': len(records), 'fields': fields, 'columns': columns}, separators=(',', ':'))
+    return {'format': 'columnar', 'payload': base64.b64encode(zlib.compress(payload.encode('utf-8'))).decode('ascii')}
+
+
+def decode_records(encoded):
+    ''' Decode records encoded with encode_records. '''
+    table = json.loads(zlib.decompress(base64.b64decode(encoded['payload'])).decode('utf-8'))
+    fields = table['fields']
+    columns = []
+    for field in fields:
+        column = table['columns'][field]
+        if 'values' in column:
+            columns.append(column['values'])
+        else:
+            distinct = column['distinct']
+            columns.append([MISSING if i is None else distinct[i] for i in column['index']])
+    if not columns:
+        return [{} for i in range(table['count'])]
+
+    records = [dict(zip(fields, row)) for row in zip(*columns)]
+    for field, column in zip(fields, columns):
+        if None in table['columns'][field].get('index', ()):
+            for record, value in zip(records, column):
+                if value is MISSING:
+                    del record[field]
+    return records
+
+
+def dump_inventory(inventory, hosts=None, groups=None):
+    ''' Return the hosts and groups of an inventory in the layout of C(ansible-inventory --list).
+
+    With I(hosts) or I(groups), only those hosts and groups are returned, besides C(all) and C(ungrouped),
+    and the members of each group are limited to them.
+    '''
+    hosts = set(inventory.hosts if hosts is None else hosts)
+    groups = set(inventory.groups if groups is None else groups) | set(('all', 'ungrouped'))
+    data = {'_meta': {'hostvars': {}}}
+    for name, host in inventory.hosts.items():
+        if name not in hosts:
+            continue
+        # the source of the hosts is set again by the inventory loading them
+        data['_meta']['hostvars'][name] = dict((k, v) for k, v in host.vars.items()
+                                               if k not in ('inventory_file', 'inventory_dir'))
+    for name, group in inventory.groups.items():
+        if name not in groups:
+            continue
+        entry = {}
+        members = [host.name for host in group.hosts if host.name in hosts]
+        if members:
+            entry['hosts'] = members
+        children = [child.name for child in group.child_groups if child.name in groups]
+        if children:
+            entry['children'] = children
+        if group.vars:
+            entry['vars'] = dict(group.vars)
+        data[name] = entry
+    return data
+
+
+class UnixHTTPConnection(http_client.HTTPConnection):
+    ''' HTTP connection over a Unix socket. '''
+
+    def __init__(self, path, timeout):
+        http_client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
+
+
+class Pipeline(object):
+    ''' Pages fetched in the background while the caller works on the current one.
+
+    The fetch starts at once, and holds at most PIPELINE_DEPTH pages in between.
+    '''
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.pipe = queue.Queue(maxsize=PIPELINE_DEPTH)
+        self.stop = threading.Event()
+        producer = threading.Thread(target=self._produce)
+        producer.daemon = True
+        producer.start()
+
+    def _put(self, item):
+        # give up once the caller is gone, as nobody would take the item
+        while not self.stop.is_set():
+            try:
+                self.pipe.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self):
+        try:
+            for page in self.pages:
+                if not self._put((page, None)):
+                    break
+        except Exception as e:
+            self._put((None, e))
+        else:
+            self._put((None, None))
+        finally:
+            # let go of the connection of an unfinished page walk
+            if hasattr(self.pages, 'close'):
+                self.pages.close()
+
+    def __iter__(self):
+        try:
+            while True:
+                page, error = self.pipe.get()
+                if error is not None:
+                    raise error
+                if page is None:
+                    break
+                yield page
+        finally:
+            self.stop.set()
+
+    def close(self):
+        # stops the fetch, also when the pages were never read
+        self.stop.set()
 
 
 class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
@@ -187,155 +889,1102 @@ class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
                     'Skipping due to inventory source not ending in "now.yaml" nor "now.yml"')
         return valid
 
-    def invoke(self, verb, path, data):
-        auth = requests.auth.HTTPBasicAuth(self.get_option('username'),
-                                           self.get_option('password'))
-        headers = {
-            "Accept": "application/json",
-            "Content-Type": "application/json",
-        }
-        proxy = self.get_option('proxy')
-
-        if self.get_option('instance'):
-            fqdn = "%s.service-now.com" % (self.get_option('instance'))
-        elif self.get_option('host'):
-            fqdn = self.get_option('host')
+    def _request(self, session, url):
+        # perform REST operation, returning the response for a page of results
+        response = session.get(url,
+                               proxies=session.proxies,
+                               timeout=self.get_option('timeout'))
+        if response.status_code == 400 and self.get_option('enhanced') and \
+                self.get_option('enhanced_source') == 'scripted_rest':
+            raise AnsibleError("http error (%s): %s. Have you installed the enhanced inventory update set on your instance?" %
+                               (response.status_code, response.text))
+        elif response.status_code != 200:
+            raise AnsibleError("http error (%s): %s" %
+                               (response.status_code, response.text))
+        return response
+
+    def _count_transfer(self, response, size):
+        # bytes received, compressed or not, and bytes of the decoded body
+        received = response.raw.tell() if hasattr(response.raw, 'tell') else size
+        with self._transfer_lock:
+            self._transfer[0] += received
+            self._transfer[1] += size
+
+    def _decode(self, response):
+        self._count_transfer(response, len(response.content))
+        return response.json()['result']
+
+    def _fetch_page(self, session, url):
+        return self._decode(self._request(session, url))
+
+    def _iter_pages(self, session, url):
+        response = self._request(session, url)
+        page = self._decode(response)
+        next_url = response.links.get('next', {}).get('url', None)
+        total = response.headers.get('X-Total-Count')
+        workers = self.get_option('page_workers')
+        yield page
+
+        if next_url and page and total and workers > 1 and HAS_FUTURES:
+            # the first page tells us the window size the instance uses, the
+            # remaining windows are fetched in parallel and yielded in order,
+            # with no more than one window per worker in flight
+            limit = len(page)
+            urls = iter([self._window(url, offset, limit) for offset in range(limit, int(total), limit)])
+            self.display.vvv("Fetching %d more records with %d workers" % (int(total) - limit, workers))
+            executor = ThreadPoolExecutor(max_workers=workers)
+            try:
+                pending = deque(executor.submit(self._fetch_page, session, u)
+                                for u in islice(urls, workers))
+                while pending:
+                    page = pending.popleft().result()
+                    for u in islice(urls, 1):
+                        pending.append(executor.submit(self._fetch_page, session, u))
+                    yield page
+            finally:
+                executor.shutdown(wait=True)
+        elif next_url and page and self.get_option('lean_transport'):
+            # pages without the count have no Link headers, so walk the
+            # windows until one comes back short
+            limit = offset = len(page)
+            while len(page) == limit:
+                page = self._fetch_page(session, self._window(url, offset, limit))
+                offset += limit
+                if page:
+                    yield page
+        else:
+            while next_url:
+                response = self._request(session, next_url)
+                next_url = response.links.get('next', {}).get('url', None)
+                yield self._decode(response)
+
+    def _window(self, url, offset, limit):
+        url = "%s&sysparm_offset=%d&sysparm_limit=%d" % (url, offset, limit)
+        if self.get_option('lean_transport'):
+            url += "&sysparm_no_count=true"
+        return url
+
+    def _with_params(self, url, **params):
+        # return url with the given query parameters replaced
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        query = dict(parse_qsl(query, keep_blank_values=True))
+        query.update(params)
+        return urlunsplit((scheme, netloc, path, urlencode(query), fragment))
+
+    def _url_param(self, url, name):
+        return dict(parse_qsl(urlsplit(url)[3], keep_blank_values=True)).get(name, '')
+
+    def _iter_keyset_pages(self, session, url):
+        # sys_id is the page bookmark, only keep it when it was asked for
+        fields = [f for f in self._url_param(url, 'sysparm_fields').split(',') if f]
+        strip_sys_id = 'sys_id' not in fields
+        if strip_sys_id:
+            url = self._with_params(url, sysparm_fields=','.join(fields + ['sys_id']))
+
+        filter_results = self._url_param(url, 'sysparm_query')
+        limit = self.get_option('page_size')
+        last_sys_id = None
+        if self.get_option('lean_transport'):
+            url = self._with_params(url, sysparm_no_count='true')
+
+        while True:
+            page = self._fetch_page(
+                session,
+                self._with_params(url, sysparm_query=keyset_query(filter_results, last_sys_id)))
+            if not page:
+                break
+            last_sys_id = page[-1]['sys_id']
+            if strip_sys_id:
+                for record in page:
+                    del record['sys_id']
+            yield page
+            if limit and len(page) < limit:
+                break
+
+    def _pages(self, session, url):
+        if self.get_option('pagination') == 'keyset':
+            return self._iter_keyset_pages(session, url)
+        return self._iter_pages(session, url)
+
+    def _fetch(self, session, url):
+        results = []
+        for page in self._pages(session, url):
+            results += page
+        return results
+
+    def _sync_incremental(self, endpoint, url):
+        session = endpoint['session']
+        fingerprint = self._fingerprint(url, 'incremental')
+        fields = [f for f in self._url_param(url, 'sysparm_fields').split(',') if f]
+        filter_results = self._url_param(url, 'sysparm_query')
+        if 'sys_id' not in fields:
+            url = self._with_params(url, sysparm_fields=','.join(fields + ['sys_id']))
+
+        snapshot = self._cache_lookup(endpoint, fingerprint)
+
+        started = time.time()
+        if not snapshot:
+            self.display.vvv("No inventory snapshot, fetching the full table")
+            records = dict((r['sys_id'], r) for r in self._fetch(session, url))
+        else:
+            records = snapshot['records']
+
+            # relative to the clock of the instance, rounded up with a minute
+            # of overlap; merging by sys_id makes re-reading records harmless
+            minutes = int(math.ceil((started - snapshot['watermark']) / 60.0)) + 1
+            since = 'sys_updated_onRELATIVEGT@minute@ago@%d' % minutes
+            changed = self._fetch(session, self._with_params(
+                url, sysparm_query=and_query(filter_results, since)))
+            for record in changed:
+                records[record['sys_id']] = record
+
+            listing = self._fetch(session, self._with_params(url, sysparm_fields='sys_id'))
+            live = set(r['sys_id'] for r in listing)
+            for sys_id in [s for s in records if s not in live]:
+                del records[sys_id]
+
+            # records that started matching the filter without being updated
+            missing = [r['sys_id'] for r in listing if r['sys_id'] not in records]
+            for i in range(0, len(missing), SYS_ID_CHUNK):
+                clause = 'sys_idIN%s' % ','.join(missing[i:i + SYS_ID_CHUNK])
+                for record in self._fetch(session, self._with_params(
+                        url, sysparm_query=and_query(filter_results, clause))):
+                    records[record['sys_id']] = record
+
+            self.display.vvv("Inventory snapshot synced: %d changed, %d added, %d records" %
+                             (len(changed), len(missing), len(records)))
+
+        self._cache_store(endpoint, fingerprint, {'watermark': started, 'records': records})
+
+        if 'sys_id' in fields:
+            return list(records.values())
+        return [dict((k, v) for k, v in r.items() if k != 'sys_id') for r in records.values()]
+
+    def _fetch_relationships(self, session, url, results):
+        # attach relationships to the records in the format returned by the
+        # scripted REST API, from one cmdb_rel_ci query per batch of CIs
+        scheme, netloc = urlsplit(url)[:2]
+        rel_url = urlunsplit((scheme, netloc, '/api/now/table/cmdb_rel_ci', urlencode({
+            'sysparm_exclude_reference_link': 'true',
+            'sysparm_display_value': 'true',
+            'sysparm_fields': 'sys_id,type,parent.sys_id,parent.name,parent.sys_class_name,'
+                              'child.sys_id,child.name,child.sys_class_name',
+        }), ''))
+        if self.get_option('page_size'):
+            rel_url = self._with_params(rel_url, sysparm_limit=self.get_option('page_size'))
+
+        sys_ids = [r['sys_id'] for r in results]
+        urls = []
+        for i in range(0, len(sys_ids), SYS_ID_CHUNK):
+            chunk = ','.join(sys_ids[i:i + SYS_ID_CHUNK])
+            urls.append(self._with_params(rel_url, sysparm_query='parentIN%s^ORchildIN%s' % (chunk, chunk)))
+
+        workers = self.get_option('page_workers')
+        if workers > 1 and HAS_FUTURES and len(urls) > 1:
+            executor = ThreadPoolExecutor(max_workers=workers)
+            try:
+                pages = list(executor.map(lambda u: self._fetch(session, u), urls))
+            finally:
+                executor.shutdown(wait=True)
         else:
-            raise AnsibleError("instance or host must be defined")
+            pages = [self._fetch(session, u) for u in urls]
+
+        # adjacency index keyed by sys_id, relationships spanning two batches
+        # are returned twice and only counted once
+        parents = {}
+        children = {}
+        seen = set()
+        for page in pages:
+            for rel in page:
+                if rel['sys_id'] in seen:
+                    continue
+                seen.add(rel['sys_id'])
+                ci_rel_type = re.sub(r'[\s:]', '_', rel['type'])
+                parents.setdefault(rel['parent.sys_id'], []).append({
+                    'ci': rel['child.name'],
+                    'ci_type': rel['child.sys_class_name'],
+                    'ci_rel_type': ci_rel_type,
+                })
+                children.setdefault(rel['child.sys_id'], []).append({
+                    'ci': rel['parent.name'],
+                    'ci_type': rel['parent.sys_class_name'],
+                    'ci_rel_type': ci_rel_type,
+                })
+
+        self.display.vvv("Fetched %d relationships for %d CIs" % (len(seen), len(results)))
+        for record in results:
+            record['parent_relationships'] = parents.get(record['sys_id'], [])
+            record['child_relationships'] = children.get(record['sys_id'], [])
+        return results
+
+    def _endpoints(self, pool_size):
+        instances = self.get_option('instances') or [dict(instance=self.get_option('instance'),
+                                                          host=self.get_option('host'))]
+        rate_limiter = None
+        if self.get_option('rate_limit'):
+            rate_limiter = RateLimiter(self.get_option('rate_limit'), self.get_option('rate_limit_burst'))
+        endpoints = []
+        for entry in instances:
+            if not isinstance(entry, dict):
+                raise AnsibleParserError('each entry of instances must be a dictionary')
+
+            if entry.get('instance'):
+                name = entry['instance']
+                fqdn = "%s.service-now.com" % (name)
+            elif entry.get('host'):
+                name = fqdn = entry['host']
+            else:
+                raise AnsibleError("instance or host must be defined")
+
+            password = entry.get('password', self.get_option('password'))
+            if password is None:
+                raise AnsibleError("password must be defined for %s" % name)
+            proxy = entry.get('proxy', self.get_option('proxy'))
+
+            # one session for every request to the instance, with a
+            # connection for each worker that may use it at the same time
+            session = requests.Session()
+            session.auth = requests.auth.HTTPBasicAuth(entry.get('username', self.get_option('username')),
+                                                       password)
+            session.headers.update({
+                "Accept": "application/json",
+                "Content-Type": "application/json",
+            })
+            session.proxies = {
+                'http': proxy,
+                'https': proxy
+            }
+            if self.get_option('lean_transport'):
+                session.headers['Accept-Encoding'] = 'gzip'
+            adapter = RetryAdapter(max_retries=self.get_option('max_retries'),
+                                   backoff=self.get_option('retry_backoff'),
+                                   max_delay=self.get_option('retry_max_delay'),
+                                   rate_limiter=rate_limiter,
+                                   pool_connections=1, pool_maxsize=max(pool_size, 10))
+            session.mount('https://', adapter)
+
+            # instances are cached apart, so refreshing one leaves the others
+            cache_key = self.cache_key
+            if self.get_option('instances'):
+                cache_key = '%s_%s' % (self.cache_key, to_safe_group_name(fqdn))
+
+            endpoints.append(dict(name=name, fqdn=fqdn, session=session, cache_key=cache_key))
+        return endpoints
+
+    def _probe(self, session, url):
+        # row count and newest update of the records behind url, from a one
+        # record request ordered by sys_updated_on
+        query = self._url_param(url, 'sysparm_query')
+        table = self._url_param(url, 'table')
+        if table:
+            # the enhanced inventory scripted REST API, ask the table instead
+            # with the same query
+            scheme, netloc = urlsplit(url)[:2]
+            url = urlunsplit((scheme, netloc, '/api/now/table/%s' % table, '', ''))
+        response = self._request(session, self._with_params(
+            url,
+            sysparm_fields='sys_updated_on',
+            sysparm_display_value='false',
+            sysparm_limit=1,
+            sysparm_query=order_query(query, 'ORDERBYDESCsys_updated_on')))
+        records = self._decode(response)
+        validator = [response.headers.get('X-Total-Count'), records[0]['sys_updated_on'] if records else None]
+        self.display.vvv("Revalidating with %s records, last updated on %s" % tuple(validator))
+        return validator
+
+    def _fingerprint(self, url, kind='records'):
+        # what a result set depends on, regardless of paging and parameter order
+        path = urlsplit(url).path
+        table = self._url_param(url, 'table') or path.rsplit('/', 1)[-1]
+        fields = sorted(set(f for f in self._url_param(url, 'sysparm_fields').split(',') if f))
+        enhanced = ''
+        if self.get_option('enhanced'):
+            enhanced = self.get_option('enhanced_source')
+        return '|'.join([kind, table, ','.join(fields), self._url_param(url, 'sysparm_query'), enhanced])
+
+    def _cache_read(self, cache, endpoint):
+        entries = {}
+        try:
+            cached = cache[endpoint['cache_key']]
+        except KeyError:
+            cached = None
+        # anything else was written by an older version of the plugin
+        if isinstance(cached, dict) and isinstance(cached.get('entries'), dict):
+            entries = dict(cached['entries'])
+
+        timeout = self.get_option('cache_entry_timeout')
+        if timeout and not self.get_option('cache_revalidate'):
+            now = time.time()
+            timeout += self.get_option('cache_stale_window')
+            entries = dict((k, v) for k, v in entries.items() if now - v['stored'] <= timeout)
+        return entries
+
+    def _cache_load(self, endpoint):
+        # hits and misses are counted for this run only
+        self._cache_entries[endpoint['cache_key']] = {
+            'entries': self._cache_read(self._cache, endpoint), 'hits': 0, 'misses': 0}
+
+    def _cache_plugin(self):
+        # a new cache plugin, as the one of the plugin keeps a copy of what it
+        # read and writes back every key on update_cache_if_changed()
+        options = dict((option, self.get_option(name)) for option, name in
+                       (('_uri', 'cache_connection'), ('_timeout', 'cache_timeout'), ('_prefix', 'cache_prefix'))
+                       if self.get_option(name) is not None)
+        return get_cache_plugin(self.get_option('cache_plugin'), **options)
+
+    def _cache_reload(self, endpoint, cache=None):
+        # pick up the result sets another process stored since the cache was
+        # loaded, keeping the newer of both
+        entries = self._cache_read(cache or self._cache_plugin(), endpoint)
+        with self._cache_lock:
+            current = self._cache_entries[endpoint['cache_key']]['entries']
+            for fingerprint, entry in entries.items():
+                if fingerprint not in current or entry['stored'] > current[fingerprint]['stored']:
+                    current[fingerprint] = entry
+                elif entry['stored'] == current[fingerprint]['stored']:
+                    current[fingerprint]['used'] = max(entry['used'], current[fingerprint]['used'])
+
+    def _lock_cache(self, endpoint):
+        # take the lock of the cache key for this process, shared by its threads
+        key = endpoint['cache_key']
+        with self._flight_lock:
+            flight = self._flights.get(key)
+            first = flight is None
+            if first:
+                flight = self._flights[key] = {'count': 0, 'lock': None, 'ready': threading.Event()}
+            flight['count'] += 1
+
+        # wait for the lock out of _flight_lock, so the threads locking other
+        # cache keys are not held up meanwhile
+        if not first:
+            flight['ready'].wait()
+            return
+        try:
+            flight['lock'] = self._acquire_lock(key)
+            self._cache_reload(endpoint)
+        except Exception:
+            flight['ready'].set()
+            self._unlock_cache(endpoint)
+            raise
+        flight['ready'].set()
+
+    def _unlock_cache(self, endpoint):
+        key = endpoint['cache_key']
+        with self._flight_lock:
+            flight = self._flights[key]
+            flight['count'] -= 1
+            if flight['count']:
+                return
+            # the result sets were written when stored
+            del self._flights[key]
+        if flight['lock'] is not None:
+            flight['lock'].close()
+
+    def _lock_path(self, key, kind):
+        # next to the cache files, or in a directory of the user
+        directory = self.get_option('cache_connection')
+        if not directory or not os.path.isdir(directory):
+            directory = private_dir()
+        return os.path.join(directory, '.%s.%s' % (key, kind))
+
+    def _acquire_lock(self, key):
+        try:
+            lock = open(self._lock_path(key, 'lock'), 'a')
+        except (IOError, OSError) as e:
+            self.display.warning("Unable to lock the inventory cache, fetching the records anyway: %s" % e)
+            return None
+
+        deadline = time.time() + self.get_option('cache_lock_timeout')
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    lock.close()
+                    raise
+            if time.time() >= deadline:
+                lock.close()
+                self.display.warning("Timed out waiting for another process to fill the inventory cache, "
+                                     "fetching the records anyway")
+                return None
+            if not waiting:
+                self.display.vvv("Waiting for another process to fill the inventory cache")
+                waiting = True
+            time.sleep(0.1)
+
+    def _cache_evict(self, entries):
+        for stale in sorted(entries, key=lambda k: entries[k]['used'])[:-self.get_option('cache_max_entries')]:
+            self.display.vvv("Evicting %s from the inventory cache" % stale)
+            del entries[stale]
 
+    def _cache_write(self, endpoint):
+        key = endpoint['cache_key']
+        if not self._cache._plugin._persistent:
+            with self._cache_lock:
+                entries = self._cache_entries[key]['entries']
+                self._cache_evict(entries)
+                self._cache[key] = {'entries': dict(entries)}
+            return
+
+        # another process, such as a background refresh, may have stored
+        # result sets since the cache was read: merge them in under a lock,
+        # then write this key alone rather than every key read by the plugin
+        cache = self._cache_plugin()
+        lock = None
+        try:
+            lock = open(self._lock_path(key, 'write'), 'a')
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        except (IOError, OSError) as e:
+            self.display.vvv("Writing the inventory cache without a lock: %s" % e)
+            if lock is not None:
+                lock.close()
+                lock = None
+        try:
+            self._cache_reload(endpoint, cache)
+            with self._cache_lock:
+                entries = self._cache_entries[key]['entries']
+                self._cache_evict(entries)
+                cache[key] = {'entries': dict(entries)}
+            cache.set_cache()
+        finally:
+            if lock is not None:
+                lock.close()
+
+    def _cache_stale(self, endpoint, fingerprint):
+        # serve an expired result set still in the staleness window and have
+        # a background process refresh the cache, at most once per timeout
+        timeout = self.get_option('cache_entry_timeout')
+        if not self.use_cache or not timeout or not self.get_option('cache_stale_window') or \
+                os.environ.get('SN_INVENTORY_REFRESH'):
+            return False
+        now = time.time()
+        with self._cache_lock:
+            entry = self._cache_entries[endpoint['cache_key']]['entries'].get(fingerprint)
+            if entry is None or now - entry['stored'] <= timeout or \
+                    now - entry['stored'] > timeout + self.get_option('cache_stale_window'):
+                return False
+        # the time of the last refresh started is kept apart from the result
+        # sets, on a marker file next to the lock
+        try:
+            marker = self._lock_path(endpoint['cache_key'], 'refresh')
+            if os.path.exists(marker) and now - os.path.getmtime(marker) <= timeout:
+                return True
+            open(marker, 'a').close()
+            os.utime(marker, None)
+        except (IOError, OSError) as e:
+            self.display.vvv("Unable to mark the inventory cache as refreshing: %s" % e)
+        self._refresh_in_background()
+        return True
+
+    def _refresh_in_background(self):
+        if self._refreshing:
+            return
+        self._refreshing = True
+
+        command = os.path.join(os.path.dirname(sys.argv[0]), 'ansible-inventory')
+        if not os.path.exists(command):
+            command = 'ansible-inventory'
+        self.display.vvv("Refreshing the inventory cache in the background")
+        # detached from the session of the run, without preexec_fn where
+        # possible, as it is not safe with the fetching threads running
+        if PY3:
+            detach = dict(start_new_session=True)
+        else:
+            detach = dict(preexec_fn=os.setsid)
+        devnull = open(os.devnull, 'r+')
+        try:
+            subprocess.Popen([command, '-i', self._config_path, '--list'],
+                             stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True,
+                             env=dict(os.environ, SN_INVENTORY_REFRESH='1'), **detach)
+        except OSError as e:
+            self.display.warning("Unable to refresh the inventory cache in the background: %s" % e)
+        finally:
+            devnull.close()
+
+    def _cache_lookup(self, endpoint, fingerprint, validator=None, stale=False):
+        if not self.use_cache:
+            return None
+        timeout = self.get_option('cache_entry_timeout')
+        with self._cache_lock:
+            cached = self._cache_entries[endpoint['cache_key']]
+            entry = cached['entries'].get(fingerprint)
+            if entry is not None and validator is not None and entry.get('validator') != validator:
+                self.display.vvv("Records of %s changed on the instance" % fingerprint)
+                entry = None
+            elif entry is not None and validator is None and not stale and timeout and \
+                    time.time() - entry['stored'] > timeout:
+                entry = None
+            if entry is None:
+                cached['misses'] += 1
+                self.display.vvv("Inventory cache miss for %s" % fingerprint)
+                return None
+            # the cache is not written for a hit, the time it was used is kept
+            # with the next result set stored
+            cached['hits'] += 1
+            entry['used'] = time.time()
+        if isinstance(entry['data'], dict) and entry['data'].get('format') == 'columnar':
+            return decode_records(entry['data'])
+        return entry['data']
+
+    def _cache_store(self, endpoint, fingerprint, value, validator=None):
+        if self.get_option('cache_format') == 'columnar' and isinstance(value, list):
+            value = encode_records(value)
+        now = time.time()
+        with self._cache_lock:
+            entries = self._cache_entries[endpoint['cache_key']]['entries']
+            entries[fingerprint] = {'stored': now, 'used': now, 'validator': validator, 'data': value}
+        self._cache_write(endpoint)
+
+    def invoke(self, verb, path, data, endpoint):
         # build url
-        self.url = "https://%s/%s" % (fqdn, path)
-        url = self.url
+        url = "https://%s/%s" % (endpoint['fqdn'], path)
         self.display.vvv("Connecting to...%s" % url)
         results = []
+        session = endpoint['session']
 
-        if not self.update_cache:
+        if self.get_option('incremental'):
+            if self._single_flight:
+                self._lock_cache(endpoint)
             try:
-                results = self._cache[self.cache_key][self.url]
-            except KeyError:
-                pass
+                yield self._sync_incremental(endpoint, url)
+            finally:
+                if self._single_flight:
+                    self._unlock_cache(endpoint)
+            return
 
-        if not results:
-            if self.cache_key not in self._cache:
-                self._cache[self.cache_key] = {self.url: ''}
+        # hold on to the pages only when they are going to be cached
+        caching = self.get_option('cache')
 
-            session = requests.Session()
+        fingerprint = self._fingerprint(url)
+        validator = None
+        stale = caching and self._cache_stale(endpoint, fingerprint)
+        if caching and not stale and self.get_option('cache_revalidate'):
+            # taken before fetching, so changes made meanwhile show next time
+            validator = self._probe(session, url)
+        cached = self._cache_lookup(endpoint, fingerprint, validator, stale)
+        if cached is not None:
+            yield cached
+            return
 
-            while url:
-                # perform REST operation, accumulating page results
-                response = session.get(url,
-                                       auth=auth,
-                                       headers=headers,
-                                       proxies={
-                                           'http': proxy,
-                                           'https': proxy
-                                       })
-                if response.status_code == 400 and self.get_option('enhanced'):
-                    raise AnsibleError("http error (%s): %s. Have you installed the enhanced inventory update set on your instance?" %
-                                       (response.status_code, response.text))
-                elif response.status_code != 200:
-                    raise AnsibleError("http error (%s): %s" %
-                                       (response.status_code, response.text))
-                results += response.json()['result']
-                next_link = response.links.get('next', {})
-                url = next_link.get('url', None)
-
-            self._cache[self.cache_key] = {self.url: results}
-
-        results = {'result': results}
-        return results
+        if self._single_flight:
+            self._lock_cache(endpoint)
+            # the records may have been fetched while waiting for the lock
+            cached = self._cache_lookup(endpoint, fingerprint, validator, stale)
+            if cached is not None:
+                self._unlock_cache(endpoint)
+                yield cached
+                return
+        pipeline = None
+        try:
+            pages = self._pages(session, url)
+            if self.get_option('enhanced') and self.get_option('enhanced_source') == 'table_api':
+                pages = (self._fetch_relationships(session, url, page) for page in pages)
+
+            pipeline = Pipeline(pages)
+            for page in pipeline:
+                if caching:
+                    results += page
+                yield page
+
+            if caching:
+                self._cache_store(endpoint, fingerprint, results, validator)
+        finally:
+            # stops the producer when the caller gave up on the pages
+            if pipeline is not None:
+                pipeline.close()
+            if self._single_flight:
+                self._unlock_cache(endpoint)
+
+    def _read_daemon(self):
+        # the inventory built by the daemon, or None when it cannot be read
+        timeout = self.get_option('daemon_timeout')
+        if self.get_option('daemon_socket'):
+            source = self.get_option('daemon_socket')
+            connection = UnixHTTPConnection(source, timeout)
+            target = '/'
+        else:
+            source = self.get_option('daemon_url')
+            parts = urlsplit(source)
+            if parts.scheme == 'https':
+                connection = http_client.HTTPSConnection(parts.netloc, timeout=timeout)
+            else:
+                connection = http_client.HTTPConnection(parts.netloc, timeout=timeout)
+            target = parts.path or '/'
+
+        try:
+            connection.request('GET', target)
+            response = connection.getresponse()
+            body = response.read()
+            if response.status != 200:
+                raise ValueError("http error (%s): %s" % (response.status, body))
+            return json.loads(body.decode('utf-8'))
+        except (socket.error, http_client.HTTPException, ValueError) as e:
+            self.display.warning("Unable to read the inventory from the daemon at %s, building it instead: %s" %
+                                 (source, e))
+            return None
+        finally:
+            connection.close()
+
+    def _load_inventory(self, data):
+        # add the hosts and groups of an inventory in the layout of
+        # ansible-inventory --list, as it was built
+        hostvars = data.pop('_meta', {}).get('hostvars', {})
+        for host, variables in hostvars.items():
+            self.inventory.add_host(host)
+            for var, value in variables.items():
+                self.inventory.set_variable(host, var, value)
+        for group, entry in data.items():
+            self.inventory.add_group(group)
+            for var, value in entry.get('vars', {}).items():
+                self.inventory.set_variable(group, var, value)
+        # hosts and groups exist by now, so adding them as children only
+        # links them
+        for group, entry in data.items():
+            for child in entry.get('children', []):
+                self.inventory.add_child(group, child)
+            for host in entry.get('hosts', []):
+                if host not in hostvars:
+                    self.inventory.add_host(host)
+                self.inventory.add_child(group, host)
+
+    def _read_artifact(self, path):
+        try:
+            with gzip.open(path, 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError) as e:
+            raise AnsibleParserError("Unable to load the inventory artifact %s: %s" % (path, e))
+
+    def _write_artifact(self, path, hosts, groups):
+        # write a temporary file next to the artifact and rename it over
+        body = json.dumps(dump_inventory(self.inventory, hosts, groups), cls=AnsibleJSONEncoder, sort_keys=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6) as compressed:
+                    compressed.write(body.encode('utf-8'))
+            os.chmod(tmp, 0o644)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise AnsibleError("Unable to write the inventory artifact %s: %s" % (path, e))
+        self.display.vvv("Wrote the inventory artifact %s" % path)
 
     def parse(self, inventory, loader, path,
               cache=True):  # Plugin interface (2)
         super(InventoryModule, self).parse(inventory, loader, path)
+        # the inventory holds the hosts and groups of the sources parsed
+        # before this one as well
+        existing_hosts = set(inventory.hosts)
+        existing_groups = set(inventory.groups)
+
+        self._read_config_data(path)
+
+        if self.get_option('load_artifact'):
+            self._load_inventory(self._read_artifact(self.get_option('load_artifact')))
+            return
+
+        # the daemon itself runs with SN_INVENTORY_DAEMON set and builds the
+        # inventory from the same configuration
+        if (self.get_option('daemon_socket') or self.get_option('daemon_url')) and \
+                not os.environ.get('SN_INVENTORY_DAEMON'):
+            data = self._read_daemon()
+            if data is not None:
+                self._load_inventory(data)
+                return
 
         if not HAS_REQUESTS:
             raise AnsibleParserError(
                 'Please install "requests" Python module as this is required'
                 ' for ServiceNow dynamic inventory plugin.')
 
-        self._read_config_data(path)
         self.cache_key = self.get_cache_key(path)
 
         self.use_cache = self.get_option('cache') and cache
-        self.update_cache = self.get_option('cache') and not cache
-
-        selection = self.get_option('selection_order')
-        fields = self.get_option('fields')
-        table = self.get_option('table')
-        filter_results = self.get_option('filter_results')
+        self._config_path = path
+        self._refreshing = False
+        self._var_names = {}
+        self._strings = {}
+        self._operands = {}
+        self._conditions = {}
+        self._transfer = [0, 0]
+        self._transfer_lock = threading.Lock()
 
         options = "?sysparm_exclude_reference_link=true&sysparm_display_value=true"
+        if self.get_option('page_size'):
+            options += "&sysparm_limit=%d" % self.get_option('page_size')
 
         enhanced = self.get_option('enhanced')
         enhanced_groups = False
 
+        enhanced_source = self.get_option('enhanced_source')
+
+        if enhanced and enhanced_source == 'scripted_rest' and self.get_option('pagination') == 'keyset':
+            raise AnsibleParserError('keyset pagination is not supported with the enhanced inventory scripted REST API')
+        if self.get_option('incremental'):
+            if enhanced:
+                raise AnsibleParserError('incremental sync is not supported with the enhanced inventory')
+            if not self.get_option('cache'):
+                raise AnsibleParserError('incremental sync requires the inventory cache to be enabled')
         if enhanced:
-            path = '/api/snc/ansible_inventory' + options + \
-                "&sysparm_fields=" + ','.join(fields) + \
-                "&sysparm_query=" + filter_results + \
-                "&table=" + table
             enhanced_groups = self.get_option('enhanced_groups')
-        else:
-            path = '/api/now/table/' + table + options + \
-                "&sysparm_fields=" + ','.join(fields) + \
-                "&sysparm_query=" + filter_results
 
-        content = self.invoke('GET', path, None)
+        specs = self._table_specs()
+        endpoints = self._endpoints(self.get_option('page_workers') * len(specs))
+        sources = []
+        for spec in specs:
+            if self.get_option('push_down_groups'):
+                spec['filter_results'] = self._push_down_groups(spec, endpoints[0])
+            if self.get_option('prune_fields'):
+                spec['fields'] = self._prune_fields(spec)
+            table = spec['table']
+            fields = spec['fields']
+            filter_results = spec['filter_results']
+
+            if enhanced and enhanced_source == 'table_api':
+                # the relationships are looked up by sys_id
+                if 'sys_id' not in fields:
+                    fields = fields + ['sys_id']
+                path = '/api/now/table/' + table + options + \
+                    "&sysparm_fields=" + ','.join(fields) + \
+                    "&sysparm_query=" + filter_results
+            elif enhanced:
+                path = '/api/snc/ansible_inventory' + options + \
+                    "&sysparm_fields=" + ','.join(fields) + \
+                    "&sysparm_query=" + filter_results + \
+                    "&table=" + table
+            else:
+                path = '/api/now/table/' + table + options + \
+                    "&sysparm_fields=" + ','.join(fields) + \
+                    "&sysparm_query=" + filter_results
+            sources.append((spec, path))
+
         strict = self.get_option('strict')
+        strip_sys_id = enhanced and enhanced_source == 'table_api'
+        federated = bool(self.get_option('instances'))
+        conflict = self.get_option('instance_conflict')
+        self._cache_entries = {}
+        self._cache_lock = threading.Lock()
+        self._flights = {}
+        self._flight_lock = threading.Lock()
+        self._single_flight = self.get_option('cache') and self.get_option('cache_lock') and \
+            self.get_option('cache_plugin') not in ('memory', 'ansible.builtin.memory')
+        if self.get_option('cache'):
+            for endpoint in endpoints:
+                self._cache_load(endpoint)
 
-        for record in content['result']:
+        jobs = [(endpoint, spec, path) for endpoint in endpoints for spec, path in sources]
+        if len(jobs) == 1:
+            endpoint, spec, path = jobs[0]
+            fetched = [self.invoke('GET', path, None, endpoint)]
+        elif not (federated and conflict == 'last'):
+            # fetch every instance and table at once, and add them in order of
+            # precedence as their pages come in
+            fetched = []
+            try:
+                for endpoint, spec, path in jobs:
+                    fetched.append(Pipeline(self.invoke('GET', path, None, endpoint)))
+            except Exception:
+                for pages in fetched:
+                    pages.close()
+                raise
+        elif HAS_FUTURES:
+            # the hosts are claimed before any is added, which needs the pages
+            # of every instance at hand
+            executor = ThreadPoolExecutor(max_workers=len(jobs))
+            try:
+                futures = [executor.submit(lambda p, e: list(self.invoke('GET', p, None, e)), path, endpoint)
+                           for endpoint, spec, path in jobs]
+                fetched = [future.result() for future in futures]
+            finally:
+                executor.shutdown(wait=True)
+        else:
+            fetched = [list(self.invoke('GET', path, None, endpoint)) for endpoint, spec, path in jobs]
 
-            target = None
+        try:
+            claimed = {}
+            if federated and conflict == 'last':
+                # the last instance returning a host owns it
+                for (endpoint, spec, path), pages in zip(jobs, fetched):
+                    for page in pages:
+                        for record in page:
+                            target = self._select_target(record, spec['selection_order'])
+                            if target is not None:
+                                claimed[target] = endpoint['name']
 
-            # select name for host
-            for k in selection:
-                if k in record:
-                    if record[k] != '':
-                        target = record[k]
-                if target is not None:
-                    break
+            owners = {}
+            for (endpoint, spec, path), pages in zip(jobs, fetched):
+                source = (endpoint['name'], spec['table'])
+                drop_sys_id = strip_sys_id and 'sys_id' not in spec['fields']
+                for page in pages:
+                    for record in page:
+                        target = self._select_target(record, spec['selection_order'])
+                        if target is None or claimed.get(target, endpoint['name']) != endpoint['name']:
+                            continue
+                        # otherwise the first instance and table returning a host own it
+                        owner = owners.setdefault(target, source)
+                        if owner != source:
+                            if owner[0] != source[0] and conflict == 'error':
+                                raise AnsibleParserError("host %s is returned by both %s and %s" %
+                                                         (target, owner[0], source[0]))
+                            self.display.vvv("Skipping %s from %s %s, already found in %s %s" %
+                                             ((target,) + source + owner))
+                            continue
+                        if drop_sys_id:
+                            record = dict((k, v) for k, v in record.items() if k != 'sys_id')
+                        if federated:
+                            record = dict(record, instance=endpoint['name'])
+                        self._add_record(target, record, enhanced_groups, strict)
+
+        finally:
+            # a host that failed to build leaves pages unread, close them so
+            # their fetch stops
+            for pages in fetched:
+                if hasattr(pages, 'close'):
+                    pages.close()
+
+        for endpoint in endpoints:
+            if endpoint['cache_key'] in self._cache_entries:
+                cached = self._cache_entries[endpoint['cache_key']]
+                self.display.vvv("Inventory cache of %s: %d hits, %d misses" %
+                                 (endpoint['name'], cached['hits'], cached['misses']))
+        if self._transfer[1]:
+            self.display.v("Received %d bytes for %d bytes of results (%.0f%%)" %
+                           (self._transfer[0], self._transfer[1], 100.0 * self._transfer[0] / self._transfer[1]))
+
+        groups = [g for g in self.inventory.groups if g not in existing_groups]
+        if self.get_option('hoist_group_vars'):
+            self._hoist_group_vars(groups)
+
+        if self.get_option('export_artifact'):
+            hosts = [h for h in self.inventory.hosts if h not in existing_hosts]
+            self._write_artifact(self.get_option('export_artifact'), hosts, groups)
+
+    def _hoist_group_vars(self, groups):
+        composed = set(self.get_option('compose') or {})
 
-            if target is None:
+        # variables with one value across the hosts of each group, looked up
+        # before any is moved, as groups overlap
+        hoisted = set()
+        for name in groups:
+            group = self.inventory.groups[name]
+            hosts = group.get_hosts()
+            if len(hosts) < 2:
                 continue
+            first = hosts[0].vars
+            uniform = {}
+            for var, value in first.items():
+                # the composed ones are often connection variables, which
+                # group_vars files are likely to set too
+                if not var.startswith('sn_') or var in composed:
+                    continue
+                if all(var in host.vars and host.vars[var] == value for host in hosts[1:]):
+                    uniform[var] = value
+            for var, value in uniform.items():
+                self.inventory.set_variable(name, var, value)
+            hoisted.update((host.name, var) for host in hosts for var in uniform)
+
+        for host_name, var in hoisted:
+            self.inventory.hosts[host_name].vars.pop(var, None)
+        self.display.vvv("Moved %d host variables to the variables of their groups" % len(hoisted))
+
+    def _plain_fields(self, endpoint, table, fields):
+        # the fields of table holding text, which have the same display and
+        # stored values, from the dictionary entry of the table or of the
+        # nearest parent defining them
+        if not fields:
+            return set()
+        url = "https://%s/api/now/table/sys_db_object?%s" % (endpoint['fqdn'], urlencode({
+            'sysparm_query': 'name=%s' % table,
+            'sysparm_fields': ','.join(['name'] + ['super_class.' * depth + 'name' for depth in range(1, TABLE_DEPTH)]),
+            'sysparm_exclude_reference_link': 'true',
+            'sysparm_limit': 1,
+        }))
+        objects = self._fetch_page(endpoint['session'], url)
+        if not objects:
+            return set()
+        tables = [objects[0].get('super_class.' * depth + 'name') for depth in range(TABLE_DEPTH)]
+        tables = [t for t in tables if t]
+
+        url = "https://%s/api/now/table/sys_dictionary?%s" % (endpoint['fqdn'], urlencode({
+            'sysparm_query': 'nameIN%s^elementIN%s' % (','.join(tables), ','.join(fields)),
+            'sysparm_fields': 'name,element,internal_type,choice',
+            'sysparm_exclude_reference_link': 'true',
+            'sysparm_limit': len(tables) * len(fields),
+        }))
+        defined = {}
+        for entry in sorted(self._fetch_page(endpoint['session'], url), key=lambda e: tables.index(e['name'])):
+            defined.setdefault(entry['element'], entry)
+        return set(field for field, entry in defined.items()
+                   if entry['internal_type'] in PLAIN_TYPES and entry['choice'] in ('', '0'))
+
+    def _push_down_groups(self, spec, endpoint):
+        # records matching the filter and any of the groups conditions
+        groups = self.get_option('groups')
+        if not groups:
+            return spec['filter_results']
+        try:
+            plain = self._plain_fields(endpoint, spec['table'], [f for f in spec['fields'] if '.' not in f])
+        except AnsibleError as e:
+            self.display.warning("Not adding the groups conditions to the query of %s, unable to look up the types "
+                                 "of its fields: %s" % (spec['table'], e))
+            return spec['filter_results']
+        fields = dict(('sn_%s' % f, f) for f in spec['fields'] if f in plain)
+        branches = []
+        for group_name, conditional in groups.items():
+            clauses = parse_condition(conditional)
+            query = clauses and encode_condition(clauses, fields)
+            if not query:
+                self.display.warning("Not adding the groups conditions to the query of %s, the condition of %s has no "
+                                     "encoded query narrowing it on plain text fields" % (spec['table'], group_name))
+                return spec['filter_results']
+            branches.append(query)
+
+        filter_results = spec['filter_results']
+        order = re.findall(r'ORDERBY(?:DESC)?[^^]*', filter_results)
+        query = '^NQ'.join(and_query(order_query(filter_results), branch) for branch in branches)
+        if order:
+            query = '^'.join([query] + order)
+        self.display.vvv("Querying %s with %s" % (spec['table'], query))
+        return query
+
+    def _prune_fields(self, spec):
+        # fields referenced as sn_ variables by the templates of the
+        # constructed options, or needed to name the hosts, and the sys_id the
+        # vars plugin looks the records up with
+        templates = [self.get_option('compose'), self.get_option('groups'), self.get_option('keyed_groups')]
+        used = set(re.findall(r'\bsn_(\w+)', ' '.join(str(template) for template in templates if template)))
+        keep = set(spec['selection_order']) | set(self.get_option('pinned_fields')) | set(['sys_id'])
+        fields = [f for f in spec['fields'] if f in keep or f.replace('.', '_') in used]
+        self.display.vvv("Not requesting unused fields of %s: %s" %
+                         (spec['table'], ', '.join(f for f in spec['fields'] if f not in fields)))
+        return fields
+
+    def _table_specs(self):
+        defaults = dict(
+            fields=self.get_option('fields'),
+            filter_results=self.get_option('filter_results'),
+            selection_order=self.get_option('selection_order'),
+        )
+        tables = self.get_option('tables')
+        if not tables:
+            return [dict(defaults, table=self.get_option('table'))]
+
+        specs = []
+        for entry in tables:
+            if not isinstance(entry, dict) or not entry.get('table'):
+                raise AnsibleParserError('each entry of tables must be a dictionary with a table key')
+            spec = dict(defaults)
+            spec.update(entry)
+            for key in ('fields', 'selection_order'):
+                if isinstance(spec[key], string_types):
+                    spec[key] = [f.strip() for f in spec[key].split(',')]
+            specs.append(spec)
+        return specs
+
+    def _select_target(self, record, selection):
+        target = None
+
+        # select name for host
+        for k in selection:
+            if k in record:
+                if record[k] != '':
+                    target = record[k]
+            if target is not None:
+                break
+
+        return target
+
+    def _compose(self, template, variables, *args, **kwargs):
+        # evaluate simple expressions directly, compiled once per parse
+        if not isinstance(template, string_types):
+            return super(InventoryModule, self)._compose(template, variables, *args, **kwargs)
+        if template not in self._operands:
+            operand = parse_operand(template)
+            try:
+                if self.get_option('use_extra_vars'):
+                    operand = None
+            except Exception:
+                pass
+            self._operands[template] = operand
+        operand = self._operands[template]
+        if operand is not None:
+            try:
+                return evaluate_operand(operand, variables)
+            except NotSimple:
+                pass
+        return super(InventoryModule, self)._compose(template, variables, *args, **kwargs)
+
+    def _add_host_to_composed_groups(self, groups, variables, host, strict=False, fetch_hostvars=True):
+        # evaluate simple conditions directly, in order with the others
+        if not groups or not isinstance(groups, dict):
+            return
+        kwargs = {} if fetch_hostvars else {'fetch_hostvars': False}
+        host_vars = variables
+        if fetch_hostvars:
+            host_vars = combine_vars(variables, self.inventory.get_host(host).get_vars())
+        for group_name in groups:
+            conditional = groups[group_name]
+            clauses = None
+            if isinstance(conditional, string_types):
+                if conditional not in self._conditions:
+                    self._conditions[conditional] = parse_condition(conditional)
+                clauses = self._conditions[conditional]
+            if clauses is not None:
+                try:
+                    if evaluate_condition(clauses, host_vars):
+                        self.inventory.add_child(self.inventory.add_group(self._sanitize_group_name(group_name)), host)
+                    continue
+                except NotSimple:
+                    pass
+            super(InventoryModule, self)._add_host_to_composed_groups({group_name: conditional}, variables, host,
+                                                                      strict, **kwargs)
+
+    def _add_record(self, target, record, enhanced_groups, strict):
+        # add host to inventory
+        host_name = self.inventory.add_host(target)
+
+        # set variables for host, sharing one copy of every variable name
+        # and string value, as most are repeated across many hosts
+        for k, value in record.items():
+            name = self._var_names.get(k)
+            if name is None:
+                name = self._var_names[k] = 'sn_%s' % k.replace('.', '_')
+            if isinstance(value, string_types):
+                value = record[k] = self._strings.setdefault(value, value)
+            self.inventory.set_variable(host_name, name, value)
+
+        # add relationship based groups
+        if enhanced_groups:
+            for item in record['child_relationships']:
+                ci = to_safe_group_name(item['ci'])
+                ci_rel_type = to_safe_group_name(
+                    item['ci_rel_type'].split('__')[0])
+                ci_type = to_safe_group_name(item['ci_type'])
+                if ci != '' and ci_rel_type != '' and ci_type != '':
+                    child_group = "%s_%s" % (ci, ci_rel_type)
+                    self.inventory.add_group(child_group)
+                    self.inventory.add_child(child_group, host_name)
+
+            for item in record['parent_relationships']:
+                ci = to_safe_group_name(item['ci'])
+                ci_rel_type = to_safe_group_name(
+                    item['ci_rel_type'].split('__')[-1])
+                ci_type = to_safe_group_name(item['ci_type'])
+
+                if ci != '' and ci_rel_type != '' and ci_type != '':
+                    child_group = "%s_%s" % (ci, ci_rel_type)
+                    self.inventory.add_group(child_group)
+                    self.inventory.add_child(child_group, host_name)
+
+        self._set_composite_vars(
+            self.get_option('compose'),
+            self.inventory.get_host(host_name).get_vars(), host_name,
+            strict)
 
-            # add host to inventory
-            host_name = self.inventory.add_host(target)
-
-            # set variables for host
-            for k in record.keys():
-                k2 = k.replace('.', '_')
-                self.inventory.set_variable(host_name, 'sn_%s' % k2, record[k])
-
-            # add relationship based groups
-            if enhanced and enhanced_groups:
-                for item in record['child_relationships']:
-                    ci = to_safe_group_name(item['ci'])
-                    ci_rel_type = to_safe_group_name(
-                        item['ci_rel_type'].split('__')[0])
-                    ci_type = to_safe_group_name(item['ci_type'])
-                    if ci != '' and ci_rel_type != '' and ci_type != '':
-                        child_group = "%s_%s" % (ci, ci_rel_type)
-                        self.inventory.add_group(child_group)
-                        self.inventory.add_child(child_group, host_name)
-
-                for item in record['parent_relationships']:
-                    ci = to_safe_group_name(item['ci'])
-                    ci_rel_type = to_safe_group_name(
-                        item['ci_rel_type'].split('__')[-1])
-                    ci_type = to_safe_group_name(item['ci_type'])
-
-                    if ci != '' and ci_rel_type != '' and ci_type != '':
-                        child_group = "%s_%s" % (ci, ci_rel_type)
-                        self.inventory.add_group(child_group)
-                        self.inventory.add_child(child_group, host_name)
-
-            self._set_composite_vars(
-                self.get_option('compose'),
-                self.inventory.get_host(host_name).get_vars(), host_name,
-                strict)
-
-            self._add_host_to_composed_groups(self.get_option('groups'),
-                                              dict(), host_name, strict)
-            self._add_host_to_keyed_groups(self.get_option('keyed_groups'),
-                                           dict(), host_name, strict)
+        self._add_host_to_composed_groups(self.get_option('groups'),
+                                          dict(), host_name, strict)
+        self._add_host_to_keyed_groups(self.get_option('keyed_groups'),
+                                       dict(), host_name, strict)
@@ -6,10 +6,26 @@
 from __future__ import absolute_import, division, print_function
 __metaclass__ = type
 import traceback
+import errno
 import logging
+import os
+import random
+import re
+import stat
+import tempfile
+import threading
 import time
+from email.utils import mktime_tz, parsedate_tz
 
 from ansible.module_utils.basic import AnsibleModule, env_fallback, missing_required_lib
+from ansible.module_utils.six import binary_type, text_type
+from ansible.module_utils.six.moves.urllib.parse import urlsplit
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
 
 # Pull in pysnow
 HAS_PYSNOW = False
@@ -29,6 +45,71 @@ try:
 except ImportError:
     REQUESTS_IMP_ERR = traceback.format_exc()
 
+# server errors worth retrying for requests that can safely be sent again
+RETRY_STATUSES = frozenset([500, 502, 503, 504])
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+class RateLimiter(object):
+    """A token bucket shared by every process of the user on this host.
+
+    The bucket of each instance is kept in a file of a directory only the
+    user can use, locked while it is updated, so forks and threads all draw
+    from it. A request that finds the bucket empty still takes its token,
+    leaving it in debt, and waits until the token would have been added, so
+    requests are served in the order they came.
+
+    :param rate: Tokens added per second
+    :param burst: Most tokens the bucket holds, defaults to one second of them
+    :param directory: Directory of the bucket files, defaults to the one of
+        :func:`private_dir`
+    """
+
+    def __init__(self, rate, burst=None, directory=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, int(self.rate)))
+        self.directory = directory
+        # without fcntl the bucket is only shared by the threads of a process
+        self._lock = threading.Lock()
+        # buckets of this process alone, when their file cannot be used
+        self._buckets = {}
+
+    def _path(self, key):
+        name = re.sub(r'[^\w.-]', '_', key)
+        return os.path.join(self.directory or private_dir(), 'rate_%s' % name)
+
+    def _take(self, state):
+        # the tokens left once one is taken from the bucket saved as state
+        now = time.time()
+        try:
+            tokens, stamp = [float(v) for v in state.split()]
+        except ValueError:
+            tokens, stamp = self.burst, now
+        tokens = min(self.burst, tokens + (now - stamp) * self.rate) - 1
+        return tokens, '%f %f' % (tokens, now)
+
+    def acquire(self, key):
+        """Take a token from the bucket of key, waiting for it if needed."""
+        with self._lock:
+            try:
+                # never write through a link left in place of the file
+                fd = os.open(self._path(key), os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+            except OSError:
+                fd = None
+            if fd is None:
+                tokens, self._buckets[key] = self._take(self._buckets.get(key, ''))
+            else:
+                with os.fdopen(fd, 'r+') as f:
+                    if HAS_FCNTL:
+                        fcntl.flock(f, fcntl.LOCK_EX)
+                    tokens, state = self._take(f.read())
+                    f.seek(0)
+                    f.truncate()
+                    f.write(state)
+                    f.flush()
+        if tokens < 0:
+            time.sleep(-tokens / self.rate)
+
 
 if HAS_REQUESTS:
     class HTTPBearerAuth(requests.auth.AuthBase):
@@ -44,10 +125,139 @@ if HAS_REQUESTS:
         def __call__(self, r):
             r.headers['Authorization'] = "Bearer {0}".format(str(self.token))
             return r
+
+    class RetryAdapter(requests.adapters.HTTPAdapter):
+        """A :class:`requests.adapters.HTTPAdapter` retrying throttled and
+        failed requests with jittered exponential backoff.
+
+        Throttled requests (429) are retried whatever their method, as the
+        instance did not process them. Server errors (5xx), connection errors
+        and timeouts are only retried for idempotent methods. A Retry-After
+        header is honored in place of the backoff.
+
+        :param max_retries: Number of retries of a request, 0 disables them
+        :param backoff: Seconds the first retry waits at most, doubled for
+            each following one
+        :param max_delay: Longest wait between two attempts, in seconds
+        :param rate_limiter: :class:`RateLimiter` to take a token from before
+            every attempt, by instance
+        """
+
+        def __init__(self, max_retries=3, backoff=1.0, max_delay=60.0, rate_limiter=None, **kwargs):
+            super(RetryAdapter, self).__init__(**kwargs)
+            self.retries = max_retries
+            self.backoff = backoff
+            self.max_delay = max_delay
+            self.rate_limiter = rate_limiter
+
+        def _delay(self, attempt, response=None):
+            retry_after = response is not None and response.headers.get('Retry-After')
+            if retry_after:
+                try:
+                    delay = float(retry_after)
+                except ValueError:
+                    date = parsedate_tz(retry_after)
+                    delay = mktime_tz(date) - time.time() if date else None
+                if delay is not None:
+                    return min(max(delay, 0), self.max_delay)
+            return random.uniform(0, min(self.max_delay, self.backoff * 2 ** attempt))
+
+        def send(self, request, **kwargs):
+            idempotent = request.method in IDEMPOTENT_METHODS
+            # streamed bodies cannot be sent again
+            replayable = request.body is None or isinstance(request.body, (binary_type, text_type))
+            attempt = 0
+            while True:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire(urlsplit(request.url).netloc)
+                try:
+                    response = super(RetryAdapter, self).send(request, **kwargs)
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    if not idempotent or attempt >= self.retries:
+                        raise
+                    time.sleep(self._delay(attempt))
+                    attempt += 1
+                    continue
+
+                status = response.status_code
+                if attempt >= self.retries or not replayable or \
+                        not (status == 429 or (idempotent and status in RETRY_STATUSES)):
+                    return response
+
+                delay = self._delay(attempt, response)
+                logging.debug("Retrying %s %s in %.1fs after http error %s", request.method, request.url, delay, status)
+                response.close()
+                time.sleep(delay)
+                attempt += 1
 else:
     class HTTPBearerAuth(object):
         pass
 
+    class RetryAdapter(object):
+        pass
+
+
+def private_dir():
+    ''' Return a directory under the temporary directory that only the current
+    user can use, creating it if needed.
+
+    Files with predictable names are kept there rather than in the shared
+    temporary directory, where another user could create them first.
+    '''
+    uid = getattr(os, 'getuid', lambda: 0)()
+    path = os.path.join(tempfile.gettempdir(), 'servicenow-%d' % uid)
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != uid or info.st_mode & 0o077:
+        raise OSError(errno.EPERM, 'not a private directory', path)
+    return path
+
+
+def and_query(query, clause):
+    ''' AND an encoded query clause into every ^NQ branch of query.
+
+    :param query: encoded query string, may be empty
+    :param clause: encoded query condition to add
+    '''
+    if not query:
+        return clause
+    return '^NQ'.join(
+        '%s^%s' % (branch, clause) for branch in query.split('^NQ')
+    )
+
+
+def order_query(query, order=''):
+    ''' Replace the ordering of an encoded query.
+
+    :param query: encoded query string, may be empty
+    :param order: ordering clause to append, e.g. ORDERBYsys_id, or
+        nothing to only drop the ordering
+    '''
+    query = re.sub(r'\^?ORDERBY(DESC)?[^^]*', '', query or '').strip('^')
+    if query and order:
+        return '%s^%s' % (query, order)
+    return query or order
+
+
+def keyset_query(query, last_sys_id=None):
+    ''' Build the encoded query for one page of keyset pagination.
+
+    Any ordering in query is dropped, the sys_id bound is added to every
+    ^NQ branch and the records are ordered by sys_id, so each page picks
+    up exactly where the previous one ended.
+
+    :param query: encoded query string, may be empty
+    :param last_sys_id: sys_id of the last record of the previous page
+    '''
+    query = order_query(query)
+    if last_sys_id is not None:
+        query = and_query(query, 'sys_id>%s' % last_sys_id)
+    return order_query(query, 'ORDERBYsys_id')
+
 
 class ServiceNowModule(AnsibleModule):
 
@@ -139,6 +349,18 @@ class ServiceNowModule(AnsibleModule):
         self.client_id = self.params.get('client_id')
         self.client_secret = self.params.get('client_secret')
         self.token = self.params.get('token')
+        self.max_retries = self.params.get('max_retries')
+        self.retry_backoff = self.params.get('retry_backoff')
+        self.retry_max_delay = self.params.get('retry_max_delay')
+        self.lean_transport = self.params.get('lean_transport')
+        if self.lean_transport:
+            # bytes received, compressed or not, and bytes of the decoded bodies
+            self.result['transfer'] = {'received': 0, 'decoded': 0}
+        if 'exclude_reference_link' in self.params and self.params['exclude_reference_link'] is None:
+            self.params['exclude_reference_link'] = bool(self.lean_transport)
+        self.rate_limiter = None
+        if self.params.get('rate_limit'):
+            self.rate_limiter = RateLimiter(self.params['rate_limit'], self.params.get('rate_limit_burst'))
 
         # OpenID
         if self.params.get('openid') is not None:
@@ -204,6 +426,7 @@ class ServiceNowModule(AnsibleModule):
                 password=self.password,
                 raise_on_empty=self.raise_on_empty
             )
+            self._mount_transport(self.connection)
         except Exception as detail:
             self.fail(
                 msg='Could not connect to ServiceNow: {0}'.format(
@@ -224,6 +447,7 @@ class ServiceNowModule(AnsibleModule):
                 host=self.host,
                 raise_on_empty=self.raise_on_empty
             )
+            self._mount_transport(self.connection)
         except Exception as detail:
             self.fail(
                 msg='Could not connect to ServiceNow: {0}'.format(
@@ -255,6 +479,7 @@ class ServiceNowModule(AnsibleModule):
             host=self.host,
             raise_on_empty=self.raise_on_empty
         )
+        self._mount_transport(self.connection)
         try:
             self.connection.set_token(self.token)
         except pysnow.exceptions.MissingToken:
@@ -266,6 +491,42 @@ class ServiceNowModule(AnsibleModule):
                 )
             )
 
+    # Transport
+    #
+    # Retry throttled and failed requests on every session of a client, and
+    # keep them lean when asked to. The OAuth client makes a new session for
+    # each resource, so the method making them is wrapped.
+    def _mount_transport(self, connection):
+        def mount(session):
+            adapter = RetryAdapter(max_retries=self.max_retries,
+                                   backoff=self.retry_backoff,
+                                   max_delay=self.retry_max_delay,
+                                   rate_limiter=self.rate_limiter)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            if self.lean_transport:
+                session.headers['Accept-Encoding'] = 'gzip'
+                session.hooks['response'].append(self._count_transfer)
+            return session
+
+        if self.lean_transport:
+            # records are fetched until a page comes back short, no request
+            # needs the count
+            connection.parameters.add_custom({'sysparm_no_count': 'true'})
+
+        get_session = connection._get_session
+        connection._get_session = lambda session: mount(get_session(session))
+        if connection.session is not None:
+            mount(connection.session)
+
+    def _count_transfer(self, response, *args, **kwargs):
+        # streamed bodies are left to their reader
+        if kwargs.get('stream'):
+            return
+        decoded = len(response.content)
+        self.result['transfer']['received'] += response.raw.tell() if hasattr(response.raw, 'tell') else decoded
+        self.result['transfer']['decoded'] += decoded
+
     # Token
     #
     # Use a supplied token instead of client id and secret.
@@ -279,6 +540,7 @@ class ServiceNowModule(AnsibleModule):
                 session=s,
                 raise_on_empty=self.raise_on_empty
             )
+            self._mount_transport(self.connection)
         except Exception as detail:
             self.fail(
                 msg='Could not connect to ServiceNow: {0}'.format(
@@ -488,6 +750,54 @@ class ServiceNowModule(AnsibleModule):
                     ['OPENID_ISSUER']
                 )
             ),
+            max_retries=dict(
+                type='int',
+                default=3,
+                fallback=(
+                    env_fallback,
+                    ['SN_MAX_RETRIES']
+                )
+            ),
+            retry_backoff=dict(
+                type='float',
+                default=1.0,
+                fallback=(
+                    env_fallback,
+                    ['SN_RETRY_BACKOFF']
+                )
+            ),
+            retry_max_delay=dict(
+                type='float',
+                default=60.0,
+                fallback=(
+                    env_fallback,
+                    ['SN_RETRY_MAX_DELAY']
+                )
+            ),
+            lean_transport=dict(
+                type='bool',
+                default=False,
+                fallback=(
+                    env_fallback,
+                    ['SN_LEAN_TRANSPORT']
+                )
+            ),
+            rate_limit=dict(
+                type='float',
+                default=0,
+                fallback=(
+                    env_fallback,
+                    ['SN_RATE_LIMIT']
+                )
+            ),
+            rate_limit_burst=dict(
+                type='int',
+                required=False,
+                fallback=(
+                    env_fallback,
+                    ['SN_RATE_LIMIT_BURST']
+                )
+            ),
             # offline_access is not supported.
             openid_scope=dict(
                 type='list',
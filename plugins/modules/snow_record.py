@@ -61,9 +61,9 @@ options:
     exclude_reference_link:
       description:
       - sysparm_exclude_reference_link
+      - Defaults to C(true) with I(lean_transport), C(false) otherwise.
       type: bool
       required: false
-      default: false
     suppress_pagination_header:
       description:
       - sysparm_suppress_pagination_header
@@ -228,6 +228,10 @@ attached_file:
    description: Details of the file that was attached via C(attachment)
    type: dict
    returned: when supported
+transfer:
+   description: Bytes received from Service Now, compressed or not, in C(received), and bytes of the decoded responses in C(decoded).
+   type: dict
+   returned: when I(lean_transport) is enabled
 '''
 
 import os
@@ -280,8 +284,7 @@ def main():
             default=False
         ),
         exclude_reference_link=dict(
-            type='bool',
-            default=False
+            type='bool'
         ),
         suppress_pagination_header=dict(
             type='bool',
@@ -42,9 +42,9 @@ options:
     exclude_reference_link:
       description:
       - sysparm_exclude_reference_link
+      - Defaults to C(true) with I(lean_transport), C(false) otherwise.
       type: bool
       required: false
-      default: false
     suppress_pagination_header:
       description:
       - sysparm_suppress_pagination_header
@@ -65,6 +65,23 @@ options:
       type: list
       required: false
       elements: str
+    page_size:
+      description:
+      - Number of records to request per page.
+      - By default, up to C(max_records) records are requested at once.
+      type: int
+      required: false
+    pagination:
+      description:
+      - How pages of records are requested when C(page_size) is less than C(max_records).
+      - C(offset) requests each page with sysparm_offset.
+      - C(keyset) orders records by sys_id and requests each page with C(sys_id>last_seen), so every page costs the same
+        and records are neither duplicated nor skipped while the table changes.
+      - With C(keyset), the first C(max_records) records in sys_id order are returned, then sorted by C(order_by).
+      type: str
+      choices: ['offset', 'keyset']
+      default: offset
+      required: false
 requirements:
     - python pysnow (pysnow)
     - python requests (requests)
@@ -177,6 +194,21 @@ EXAMPLES = r'''
       - number
       - opened_at
 
+- name: Walk a large table in pages of 1000 records ordered by sys_id
+  servicenow.servicenow.snow_record_find:
+    username: ansible_test
+    password: my_password
+    instance: dev99999
+    table: cmdb_ci_server
+    query:
+      operational_status: "1"
+    max_records: 50000
+    page_size: 1000
+    pagination: keyset
+    return_fields:
+      - name
+      - ip_address
+
 - name: Find open standard changes with my template
   servicenow.servicenow.snow_record_find:
     username: ansible_test
@@ -210,9 +242,13 @@ record:
     description: The full contents of the matching ServiceNow records as a list of records.
     type: dict
     returned: always
+transfer:
+    description: Bytes received from ServiceNow, compressed or not, in C(received), and bytes of the decoded responses in C(decoded).
+    type: dict
+    returned: when I(lean_transport) is enabled
 '''
 
-from ansible_collections.servicenow.servicenow.plugins.module_utils.service_now import ServiceNowModule
+from ansible_collections.servicenow.servicenow.plugins.module_utils.service_now import ServiceNowModule, keyset_query
 from ansible.module_utils._text import to_native
 
 try:
@@ -238,6 +274,8 @@ class SnowRecordFind(object):
         self.max_records = self.module.params['max_records']
         self.order_by = self.module.params['order_by']
         self.return_fields = self.module.params['return_fields']
+        self.page_size = self.module.params['page_size']
+        self.pagination = self.module.params['pagination']
 
         # Define sort criteria
         self.reverse = False
@@ -335,18 +373,66 @@ class SnowRecordFind(object):
                     return key
             return None
 
-    def execute(self):
+    def _get(self, query, limit, fields, offset=0):
         try:
             response = self.table.get(
-                query=self.query,
-                limit=self.max_records,
-                fields=self.return_fields)
+                query=query,
+                limit=limit,
+                offset=offset,
+                fields=fields)
         except Exception as detail:
             self.module.fail(
                 msg='Failed to find record: {0}'.format(to_native(detail))
             )
+        return list(response.all())
+
+    def _offset_pages(self):
+        rlist = []
+        while len(rlist) < self.max_records:
+            page = self._get(
+                self.query,
+                min(self.page_size, self.max_records - len(rlist)),
+                self.return_fields,
+                offset=len(rlist))
+            rlist += page
+            if len(page) < self.page_size:
+                break
+        return rlist
+
+    def _keyset_pages(self):
+        # sys_id is the page bookmark, only keep it when it was asked for
+        fields = self.return_fields
+        strip_sys_id = bool(fields) and 'sys_id' not in fields
+        if strip_sys_id:
+            fields = fields + ['sys_id']
+
+        query = str(self.query)
+        last_sys_id = None
+        rlist = []
+        while len(rlist) < self.max_records:
+            page = self._get(
+                keyset_query(query, last_sys_id),
+                min(self.page_size, self.max_records - len(rlist)),
+                fields)
+            if not page:
+                break
+            last_sys_id = page[-1]['sys_id']
+            if strip_sys_id:
+                for record in page:
+                    del record['sys_id']
+            rlist += page
+            if len(page) < self.page_size:
+                break
+        return rlist
+
+    def execute(self):
+        if self.page_size and self.pagination == 'keyset':
+            rlist = self._keyset_pages()
+        elif self.page_size and self.page_size < self.max_records:
+            rlist = self._offset_pages()
+        else:
+            rlist = self._get(self.query, self.max_records, self.return_fields)
 
-        rlist = response.all()
         if len(rlist) > 0:
             self.order_by = self._sort_key(rlist[0])
         if self.order_by is not None:
@@ -382,8 +468,7 @@ def main():
             default=False
         ),
         exclude_reference_link=dict(
-            type='bool',
-            default=False
+            type='bool'
         ),
         suppress_pagination_header=dict(
             type='bool',
@@ -397,6 +482,14 @@ def main():
             type='list',
             elements='str',
             default=[]
+        ),
+        page_size=dict(
+            type='int'
+        ),
+        pagination=dict(
+            type='str',
+            choices=['offset', 'keyset'],
+            default='offset'
         )
     )
 
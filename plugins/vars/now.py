@@ -0,0 +1,259 @@
+#
+# Copyright: (c), Ansible Project
+#
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+DOCUMENTATION = r'''
+    name: servicenow.servicenow.now
+    plugin_type: vars
+    author:
+      - Will Tome (@willtome)
+      - Alex Mittell (@alex_mittell)
+    short_description: ServiceNow extended host variables
+    description:
+        - Adds host variables from ServiceNow to the hosts of the C(servicenow.servicenow.now) inventory plugin, only
+          when they are needed, so the inventory can request just the fields used for selection and grouping.
+        - The record of a host is found from its C(sn_sys_id) variable, so C(sys_id) must be in the I(fields) of the
+          inventory. Hosts without it are left alone.
+        - Records are fetched with C(sys_idIN) queries, together with the other hosts of the smallest group of the
+          host that are not fetched yet, and remembered for the rest of the run.
+        - Fields are named like in the inventory plugin, C(model_id.model_name) becomes C(sn_model_id_model_name).
+        - Like every vars plugin of a collection, it must be enabled in C(vars_plugins_enabled).
+    extends_documentation_fragment:
+        - vars_plugin_staging
+    requirements:
+        - python requests (requests)
+    options:
+        instance:
+          description:
+          - The ServiceNow instance name, without the domain, service-now.com.
+          - Hosts with a C(sn_instance) variable, from the I(instances) option of the inventory, are looked up on
+            that instance instead.
+          - Every instance is queried with the I(username) and I(password) of this plugin, the credentials given to
+            each of the I(instances) of the inventory are not known to it. Hosts of an instance that does not
+            accept them fail to get their variables.
+          type: str
+          env:
+            - name: SN_INSTANCE
+          ini:
+            - section: servicenow_vars
+              key: instance
+        host:
+          description:
+          - The ServiceNow hostname.
+          - Mutually exclusive with C(instance).
+          type: str
+          env:
+            - name: SN_HOST
+          ini:
+            - section: servicenow_vars
+              key: host
+        username:
+          description: Name of user for connection to ServiceNow.
+          type: str
+          env:
+            - name: SN_USERNAME
+          ini:
+            - section: servicenow_vars
+              key: username
+        password:
+          description: Password for username.
+          type: str
+          env:
+            - name: SN_PASSWORD
+          ini:
+            - section: servicenow_vars
+              key: password
+        proxy:
+          description: Proxy server to use for requests to ServiceNow.
+          type: str
+          default: ''
+          env:
+            - name: SN_PROXY
+          ini:
+            - section: servicenow_vars
+              key: proxy
+        timeout:
+          description: Seconds to wait for the instance to accept a connection, then for each part of a response.
+          type: float
+          default: 60.0
+          env:
+            - name: SN_TIMEOUT
+          ini:
+            - section: servicenow_vars
+              key: timeout
+        table:
+          description: The ServiceNow table to query, usually the I(table) of the inventory.
+          type: str
+          default: cmdb_ci_server
+          env:
+            - name: SN_VARS_TABLE
+          ini:
+            - section: servicenow_vars
+              key: table
+        fields:
+          description:
+          - Comma seperated string providing the table columns to add as host vars.
+          - Related table fields are valid.
+          type: list
+          default: []
+          env:
+            - name: SN_VARS_FIELDS
+          ini:
+            - section: servicenow_vars
+              key: fields
+        batch_size:
+          description: Largest number of records fetched with one request.
+          type: int
+          default: 100
+          env:
+            - name: SN_VARS_BATCH_SIZE
+          ini:
+            - section: servicenow_vars
+              key: batch_size
+'''
+
+EXAMPLES = r'''
+# ansible.cfg
+# [defaults]
+# vars_plugins_enabled = host_group_vars,servicenow.servicenow.now
+#
+# [servicenow_vars]
+# instance = dev89007
+# fields = os,os_version,cpu_count,ram,location,assigned_to,support_group,model_id.model_name
+
+# now.yml, with only the fields needed to select and group hosts
+plugin: servicenow.servicenow.now
+instance: dev89007
+fields: [sys_id,name,ip_address,sys_class_name,classification]
+keyed_groups:
+  - key: sn_classification | lower
+    prefix: env
+'''
+
+from ansible.errors import AnsibleError
+from ansible.module_utils.six.moves.urllib.parse import urlencode
+from ansible.plugins.vars import BaseVarsPlugin
+from ansible_collections.servicenow.servicenow.plugins.module_utils.service_now import RetryAdapter
+
+try:
+    import requests
+    HAS_REQUESTS = True
+except ImportError:
+    HAS_REQUESTS = False
+
+# records already fetched in this run, by instance and sys_id
+FETCHED = {}
+SESSIONS = {}
+
+
+class VarsModule(BaseVarsPlugin):
+
+    def _session(self):
+        key = (self.get_option('username'), self.get_option('proxy'))
+        session = SESSIONS.get(key)
+        if session is None:
+            session = SESSIONS[key] = requests.Session()
+            session.auth = requests.auth.HTTPBasicAuth(self.get_option('username'),
+                                                       self.get_option('password'))
+            session.headers.update({
+                "Accept": "application/json",
+                "Content-Type": "application/json",
+            })
+            session.proxies = {
+                'http': self.get_option('proxy'),
+                'https': self.get_option('proxy')
+            }
+            session.mount('https://', RetryAdapter())
+        return session
+
+    def _fqdn(self, host):
+        # hosts of a multi instance inventory know where they come from,
+        # unless the variable was hoisted into one of their groups
+        name = host.vars.get('sn_instance')
+        for group in host.get_groups():
+            if name:
+                break
+            name = group.vars.get('sn_instance')
+        if not name:
+            if self.get_option('instance'):
+                name = self.get_option('instance')
+            elif self.get_option('host'):
+                return self.get_option('host')
+            else:
+                raise AnsibleError("instance or host must be defined")
+        if '.' not in name:
+            return "%s.service-now.com" % (name)
+        return name
+
+    def _batch(self, host, fqdn):
+        # the host and the other hosts of its smallest group from the same
+        # instance that are still to be fetched, as a play usually targets
+        # whole groups
+        batch = [host.vars['sn_sys_id']]
+        # the parents of its groups are returned too, but only hold the
+        # hosts of their children
+        groups = [g for g in host.get_groups() if g.name != 'all' and g.hosts]
+        if not groups:
+            return batch
+
+        seen = set(batch)
+        for sibling in min(groups, key=lambda g: len(g.hosts)).hosts:
+            if len(batch) >= self.get_option('batch_size'):
+                break
+            sys_id = sibling.vars.get('sn_sys_id')
+            if sys_id and sys_id not in seen and (fqdn, sys_id) not in FETCHED and \
+                    self._fqdn(sibling) == fqdn:
+                seen.add(sys_id)
+                batch.append(sys_id)
+        return batch
+
+    def _fetch(self, fqdn, batch):
+        fields = self.get_option('fields')
+        url = "https://%s/api/now/table/%s?%s" % (fqdn, self.get_option('table'), urlencode({
+            'sysparm_exclude_reference_link': 'true',
+            'sysparm_display_value': 'true',
+            'sysparm_fields': ','.join(['sys_id'] + [f for f in fields if f != 'sys_id']),
+            'sysparm_query': 'sys_idIN%s' % ','.join(batch),
+            'sysparm_limit': len(batch),
+        }))
+        self._display.vvv("fetching %d records from %s" % (len(batch), fqdn))
+
+        session = self._session()
+        response = session.get(url, proxies=session.proxies, timeout=self.get_option('timeout'))
+        if response.status_code != 200:
+            raise AnsibleError("http error (%s): %s" %
+                               (response.status_code, response.text))
+
+        # remember the records that were not found too, so they are not
+        # asked for again
+        for sys_id in batch:
+            FETCHED[(fqdn, sys_id)] = {}
+        for record in response.json()['result']:
+            FETCHED[(fqdn, record['sys_id'])] = dict(
+                ('sn_%s' % k.replace('.', '_'), v) for k, v in record.items() if k in fields)
+
+    def get_vars(self, loader, path, entities, cache=True):
+        super(VarsModule, self).get_vars(loader, path, entities)
+
+        if not isinstance(entities, list):
+            entities = [entities]
+
+        data = {}
+        for entity in entities:
+            # groups have no record, only hosts with a sys_id do
+            sys_id = getattr(entity, 'vars', {}).get('sn_sys_id') if hasattr(entity, 'get_groups') else None
+            if not sys_id or not self.get_option('fields'):
+                continue
+
+            if not HAS_REQUESTS:
+                raise AnsibleError('This vars plugin requires requests: https://pypi.org/project/requests/')
+
+            fqdn = self._fqdn(entity)
+            if not cache or (fqdn, sys_id) not in FETCHED:
+                self._fetch(fqdn, self._batch(entity, fqdn))
+            data.update(FETCHED[(fqdn, sys_id)])
+        return data
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# Copyright: (c), Ansible Project
+#
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+'''
+Keep a ServiceNow inventory built and serve it to the ansible runs of the controller.
+
+The inventory is built from a C(servicenow.servicenow.now) configuration file, with the inventory plugin, then
+rebuilt every I(--interval) seconds, which only fetches the changes with C(incremental: true) and a persistent cache
+plugin. It is served as JSON in the layout of C(ansible-inventory --list), to the inventory plugin set with
+C(daemon_socket) or C(daemon_url), on every GET request.
+
+    python inventory_daemon.py --socket /run/servicenow/inventory.sock now.yml
+'''
+
+from __future__ import absolute_import, division, print_function
+__metaclass__ = type
+
+import argparse
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+# find this collection without it being configured
+COLLECTIONS_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', '..'))
+os.environ['ANSIBLE_COLLECTIONS_PATH'] = os.pathsep.join(
+    [p for p in (COLLECTIONS_PATH, os.environ.get('ANSIBLE_COLLECTIONS_PATH')) if p])
+# fail rather than serve an empty inventory, and have the plugin build it
+os.environ['ANSIBLE_INVENTORY_UNPARSED_FAILED'] = 'True'
+os.environ['SN_INVENTORY_DAEMON'] = '1'
+
+import json  # noqa: E402
+
+from ansible.errors import AnsibleError  # noqa: E402
+from ansible.inventory.manager import InventoryManager  # noqa: E402
+from ansible.module_utils.six.moves import BaseHTTPServer, socketserver  # noqa: E402
+from ansible.parsing.ajson import AnsibleJSONEncoder  # noqa: E402
+from ansible.parsing.dataloader import DataLoader  # noqa: E402
+from ansible.utils.display import Display  # noqa: E402
+
+try:
+    from ansible.plugins.loader import init_plugin_loader
+except ImportError:
+    # the collection loader is set up on import before ansible-core 2.15
+    init_plugin_loader = None
+
+display = Display()
+
+
+class Snapshot(object):
+    ''' The last inventory built, as a JSON document. '''
+
+    def __init__(self, source):
+        self.source = source
+        self.body = None
+        self.built = None
+        self.lock = threading.Lock()
+
+    def build(self):
+        # imported once the collection loader is set up
+        from ansible_collections.servicenow.servicenow.plugins.inventory.now import dump_inventory
+
+        start = time.time()
+        inventory = InventoryManager(loader=DataLoader(), sources=[self.source])
+        body = json.dumps(dump_inventory(inventory), cls=AnsibleJSONEncoder, sort_keys=True).encode('utf-8')
+        with self.lock:
+            self.body = body
+            self.built = time.time()
+        display.display("Built the inventory of %d hosts in %.1fs" % (len(inventory.hosts), time.time() - start))
+
+    def get(self):
+        with self.lock:
+            return self.body, self.built
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body, built = self.server.snapshot.get()
+        if body is None:
+            self.send_error(503, 'inventory not built yet')
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Last-Modified', self.date_time_string(built))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # clients of a Unix socket have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        display.vvv("%s %s" % (self.address_string(), format % args))
+
+
+class HTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        os.chmod(self.server_address, self.mode)
+
+
+def refresh(snapshot, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            snapshot.build()
+        except Exception as e:
+            # keep serving the last inventory built, whatever went wrong, as
+            # the thread would otherwise stop refreshing it for good
+            display.warning("Unable to refresh the inventory: %s" % e)
+            display.vvv(traceback.format_exc())
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('source', help='servicenow.servicenow.now inventory configuration file')
+    listen = parser.add_mutually_exclusive_group(required=True)
+    listen.add_argument('--socket', help='path of the Unix socket to serve the inventory on')
+    listen.add_argument('--listen', metavar='HOST:PORT', help='address to serve the inventory on over HTTP')
+    parser.add_argument('--mode', default='660', help='permissions of the Unix socket, in octal (default: 660)')
+    parser.add_argument('--interval', type=int, default=300, help='seconds between refreshes (default: 300)')
+    parser.add_argument('-v', '--verbose', action='count', default=0)
+    options = parser.parse_args(args)
+    display.verbosity = options.verbose
+
+    if init_plugin_loader is not None:
+        init_plugin_loader()
+
+    snapshot = Snapshot(os.path.abspath(options.source))
+    try:
+        snapshot.build()
+    except AnsibleError as e:
+        display.error("Unable to build the inventory: %s" % e)
+        return 1
+
+    if options.socket:
+        UnixHTTPServer.mode = int(options.mode, 8)
+        server = UnixHTTPServer(options.socket, Handler)
+    else:
+        host, port = options.listen.rsplit(':', 1)
+        server = HTTPServer((host, int(port)), Handler)
+    server.snapshot = snapshot
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+
+    thread = threading.Thread(target=refresh, args=(snapshot, options.interval))
+    thread.daemon = True
+    thread.start()
+
+    display.display("Serving the inventory on %s" % (options.socket or options.listen))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if options.socket and os.path.exists(options.socket):
+            os.unlink(options.socket)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())